@@ -6,6 +6,7 @@ from openai.types.chat.chat_completion import Choice
 
 from kibernikto.interactors import OpenAIExecutor, OpenAiExecutorConfig, OpenAIRoles
 from kibernikto.utils.ai_tools import run_tool_calls
+from kibernikto.utils.tool_results import serialize_result
 from ._prompt import AGENTS_PROMPT
 
 
@@ -59,6 +60,11 @@ class KiberniktoAgent(OpenAIExecutor):
             wai += f"\n\n{agents_prompt}"
         return dict(role=OpenAIRoles.system.value, content=f"{wai}")
 
+    @property
+    def history_key(self) -> str:
+        # agents of one user share the unique_id
+        return f"{self.label}:{self.unique_id}"
+
     def get_task_delegate(self, agent_label: str):
         for agent in self.agents:
             if agent.label == agent_label:
@@ -76,9 +82,11 @@ class IrrelevantKiberniktoAgent(KiberniktoAgent):
 
     async def process_tool_calls(self, choice: Choice, original_request_text: str, save_to_history=True, iteration=0,
                                  call_session_id: str = None, recursive_results: list = ()):
-        tool_call_messages = await run_tool_calls(choice=choice, available_tools=self.tools,
-                                                  unique_id=self.unique_id, call_session_id=call_session_id)
-        content = tool_call_messages[1]['content']
+        full_results = {}
+        await run_tool_calls(choice=choice, available_tools=self.tools, unique_id=self.unique_id,
+                             call_session_id=call_session_id, full_results=full_results)
+        # the result goes to the caller, not to the prompt: no need to cut it
+        content = serialize_result(full_results[choice.message.tool_calls[0].id])
 
         return content
 
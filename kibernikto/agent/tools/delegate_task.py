@@ -69,5 +69,6 @@ def delegate_task_tool():
     }
 
 
+# a whole agent turn of the delegate: not limited by OPENAI_TOOLS_TIMEOUT
 delegate_box: Toolbox = Toolbox(function_name="delegate_task",
-                                definition=delegate_task_tool(), implementation=delegate_task)
+                                definition=delegate_task_tool(), implementation=delegate_task, timeout=0)
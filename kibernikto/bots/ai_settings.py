@@ -1,3 +1,5 @@
+from typing import Any, Literal, Dict, List
+
 from pydantic_settings import BaseSettings
 
 _DEFAULT_TEXT = """
@@ -11,17 +13,60 @@ class AiSettings(BaseSettings):
     OPENAI_API_KEY: str | None = None  # this means kibernikto is off
     OPENAI_MAX_TOKENS: int = 800
     OPENAI_MAX_MESSAGES: int = 7
-    OPENAI_MAX_RETRIES: int = 5
+    OPENAI_MAX_RETRIES: int = 5  # the rate limiter does these itself for the paced calls
+    OPENAI_TIMEOUT: float | None = None
+    OPENAI_MAX_CONNECTIONS: int = 1000
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 100
+    OPENAI_KEEPALIVE_EXPIRY: float = 30.0
+    OPENAI_MAX_CONCURRENCY: int = 0  # concurrent calls per endpoint and model, 0 for no limit
+    OPENAI_MODEL_CONCURRENCY: Dict[str, int] = {}  # per model limits, e.g. {"gpt-4.1": 20}
+    OPENAI_RATE_LIMITER: bool = True  # pace the calls by the provider x-ratelimit-* headers
+    OPENAI_RATE_LIMIT_HEADROOM: float = 0.05  # part of the quota to leave unused
+    # equivalent endpoints to fail over to, e.g. [{"url": "https://...", "key": "...", "model": "...",
+    # "models": {"gpt-4.1-mini": "openai/gpt-4.1-mini"}}]
+    OPENAI_FALLBACK_ENDPOINTS: List[Dict[str, Any]] = []
+    OPENAI_HEDGE_REQUESTS: bool = False  # also call the next endpoint when the current one is slower than usual
+    OPENAI_HEDGE_PERCENTILE: float = 0.95
+    OPENAI_HEDGE_DEFAULT_DELAY: float = 15.0  # seconds, until the endpoint latency is known
+    OPENAI_HEDGE_MIN_DELAY: float = 1.0
+    OPENAI_BATCH_WINDOW: float = 10.0  # seconds to collect batch requests before sending
+    OPENAI_BATCH_MAX_SIZE: int = 5000
+    OPENAI_BATCH_POLL_INTERVAL: float = 15.0
+    OPENAI_BATCH_MAX_POLL_INTERVAL: float = 600.0
     OPENAI_TEMPERATURE: float = 0.7
     OPENAI_RESET_CALL: str = "reset yrself"
     OPENAI_TOOLS_ENABLED: bool = True
     OPENAI_TOOLS_DEEPNESS_LEVEL: int = 5
+    OPENAI_TOOLS_TIMEOUT: float = 120.0  # seconds for a tool to answer, 0 for no limit
+    OPENAI_TOOLS_THREADS: int = 16  # thread pool for blocking tools
+    OPENAI_TOOLS_PROCESSES: int = 0  # process pool for CPU heavy tools, 0 for the CPU count
+    OPENAI_TOOLS_MAX_RESULT_TOKENS: int = 4000  # one tool result budget, 0 for no limit
+    OPENAI_TOOLS_TURN_RESULT_TOKENS: int = 12000  # all the results of one model answer, 0 for no limit
+    OPENAI_TOOLS_SUMMARY_MODEL: str | None = None  # small model to summarize big results instead of cutting
     OPENAI_WHO_AM_I: str = _DEFAULT_TEXT
-    OPENAI_SUMMARY: str | None = None  # deprecated
+    OPENAI_CASCADE_MODEL: str | None = None  # small fast model for simple turns, None for no cascade
+    OPENAI_CASCADE_CLASSIFIER: bool = False  # ask the small model about the turns heuristics can not route
+    OPENAI_CASCADE_SIMPLE_WORDS: int = 12  # shorter turns go to the small model
+    OPENAI_CASCADE_MAX_WORDS: int = 80  # longer turns go to the main model
+    OPENAI_SUMMARY: str | None = None  # custom summarization request for the history compaction
+    OPENAI_SUMMARY_MODEL: str | None = None  # cheap model to fold old history into a summary, None for no folding
+    OPENAI_SUMMARY_THRESHOLD_TOKENS: int = 6000
     OPENAI_INSTANCE_ID: str = "kbnkt"
     OPENAI_MAX_WORDS: int = 0
+    OPENAI_MAX_HISTORY_TOKENS: int = 0  # history budget, 0 for no limit
+    OPENAI_PROMPT_CACHE: bool = False
+    OPENAI_PROMPT_CACHE_KEY_FIELD: Literal['prompt_cache_key', 'user'] = 'prompt_cache_key'
+    OPENAI_RESPONSE_CACHE: bool = False  # cache stateless single requests and plugin calls
+    OPENAI_RESPONSE_CACHE_TTL: int = 3600
+    OPENAI_RESPONSE_CACHE_SIZE: int = 1024
+    OPENAI_COALESCE_REQUESTS: bool = True  # send identical stateless requests in flight only once
     OPENAI_INPUT_PRICE: float | None = None
     OPENAI_OUTPUT_PRICE: float | None = None
+    OPENAI_HISTORY_DB: str | None = None  # sqlite file to persist conversations in
+    OPENAI_HISTORY_FLUSH_INTERVAL: float = 2.0
+    OPENAI_HISTORY_KEEP_MESSAGES: int = 200
+    OPENAI_HISTORY_COMPRESS: bool = False  # zlib the long contents of the older messages in memory
+    OPENAI_HISTORY_HOT_MESSAGES: int = 6  # latest messages never compressed
 
 
 AI_SETTINGS = AiSettings()
@@ -1,13 +1,13 @@
 import logging
 import traceback
-from typing import Literal
+from typing import Literal, AsyncIterator
 
 from openai import PermissionDeniedError, AsyncOpenAI
 from openai._types import NOT_GIVEN
 
 from kibernikto.interactors.openai_executor import DEFAULT_CONFIG
 from kibernikto.telegram.telegram_bot import TelegramBot, KiberniktoChatInfo
-from kibernikto.interactors import OpenAiExecutorConfig, OpenAIRoles
+from kibernikto.interactors import OpenAiExecutorConfig, OpenAIRoles, get_client, is_shared_client
 
 
 class Kibernikto(TelegramBot):
@@ -85,6 +85,34 @@ class Kibernikto(TelegramBot):
                 print(traceback.format_exc())
                 return f"Я не справился! Горе мне! {str(e)}"
 
+    async def heed_and_reply_stream(self, message: str, author=NOT_GIVEN, save_to_history=True,
+                                    additional_content=None) -> AsyncIterator[str]:
+        if self.username in message:
+            message_to_send = message.replace(f"@{self.username}", '')
+        else:
+            message_to_send = message
+
+        parent_call_obj = {
+            'message': message_to_send,
+            'author': author,
+            'save_to_history': save_to_history,
+            'additional_content': additional_content
+        }
+
+        try:
+            async for delta in super().heed_and_reply_stream(**parent_call_obj):
+                yield delta
+        except PermissionDeniedError as pde:
+            if not self.hide_errors:
+                raise
+            logging.warning(f"Что-то грубое и недопустимое! {str(pde)}")
+            yield "Что-то грубое и недопустимое в ваших словах!"
+        except Exception as e:
+            if not self.hide_errors:
+                raise
+            print(traceback.format_exc())
+            yield f"Я не справился! Горе мне! {str(e)}"
+
     def _reset(self, **kwargs):
         """
         Adding additional data to default system message
@@ -121,9 +149,10 @@ class Kibernikto(TelegramBot):
         if self.restrict_client_instance is True:
             raise RuntimeError("updating the running instance config is restricted!")
         if self.full_config.key != config_to_use.key or self.full_config.url != config_to_use.url:
-            await self.client.close()
-            self.client = AsyncOpenAI(base_url=config_to_use.url, api_key=config_to_use.key,
-                                      max_retries=DEFAULT_CONFIG.max_retries)
+            if not is_shared_client(self.client):
+                await self.client.close()
+            self.client = get_client(base_url=config_to_use.url, api_key=config_to_use.key,
+                                     max_retries=config_to_use.max_retries)
 
         self.full_config = config_to_use
         self.model = config_to_use.model
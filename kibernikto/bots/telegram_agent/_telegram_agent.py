@@ -1,6 +1,6 @@
 import logging
 import traceback
-from typing import Literal
+from typing import Literal, AsyncIterator
 
 from openai import PermissionDeniedError, AsyncOpenAI
 from openai._types import NOT_GIVEN
@@ -71,6 +71,36 @@ class KiberniktoTelegramAgent(KiberniktoAgent):
                 print(traceback.format_exc())
                 return f"Я не справился! Горе мне! {str(e)}"
 
+    async def request_llm_stream(self, message: str, author=NOT_GIVEN, save_to_history=True,
+                                 additional_content: dict = None, with_history: bool = True,
+                                 custom_model: str = None, call_session_id: str = None) -> AsyncIterator[str]:
+        if self.username in message:
+            message_to_send = message.replace(f"@{self.username}", '')
+        else:
+            message_to_send = message
+
+        parent_call_obj = {
+            'message': message_to_send,
+            'author': author,
+            'save_to_history': save_to_history,
+            'additional_content': additional_content,
+            'call_session_id': call_session_id
+        }
+
+        try:
+            async for delta in super().request_llm_stream(**parent_call_obj):
+                yield delta
+        except PermissionDeniedError as pde:
+            if not self.hide_errors:
+                raise
+            logging.warning(f"Что-то грубое и недопустимое! {str(pde)}")
+            yield "Что-то грубое и недопустимое в ваших словах!"
+        except Exception as e:
+            if not self.hide_errors:
+                raise
+            print(traceback.format_exc())
+            yield f"Я не справился! Горе мне! {str(e)}"
+
     def should_react(self, message_text):
         if not message_text:
             return False
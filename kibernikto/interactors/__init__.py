@@ -1 +1,8 @@
 from .openai_executor import OpenAIRoles, OpenAIExecutor, OpenAiExecutorConfig, DEFAULT_CONFIG
+from .clients import get_client, close_clients, is_shared_client
+from .history_store import HistoryStore, SQLiteHistoryStore, get_history_store, set_history_store, close_history_store
+from .scheduler import LLM_SCHEDULER, LLMScheduler, Priority, turn_priority
+from .rate_limiter import RATE_LIMITER, RateLimiter
+from .hedging import ExecutorEndpoint, ENDPOINT_STATS
+from .batch import BatchSubmitter, BatchError, get_batch_submitter, close_batch_submitters, batch_stats
+from .cascade import CASCADE_STATS
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Dict, Tuple
+
+from openai import AsyncOpenAI
+from openai._types import NotGiven
+from openai.types import Batch
+from openai.types.chat import ChatCompletion
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.utils.metrics import METRICS
+
+logger = logging.getLogger("kibernikto.batch")
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchError(Exception):
+    """
+    The request was not answered by the batch.
+    """
+    pass
+
+
+def batch_body(completion_dict: dict) -> dict:
+    """
+    Converts chat.completions.create kwargs to the batch request body.
+    Client level params are dropped and extra_body is merged in.
+    """
+    body = {key: value for key, value in completion_dict.items()
+            if key not in ('extra_headers', 'extra_body', 'extra_query', 'timeout', 'stream')
+            and not isinstance(value, NotGiven)}
+    if completion_dict.get('extra_body'):
+        body.update(completion_dict['extra_body'])
+    return body
+
+
+class BatchSubmitter:
+    """
+    Collects chat completion requests into Batch API jobs: half the price, hours instead of seconds.
+    Only for bulk non-interactive work, i.e. nightly summaries.
+    Requests submitted within the window go to one batch, each caller awaits its own result.
+    """
+
+    def __init__(self, client: AsyncOpenAI,
+                 window: float = AI_SETTINGS.OPENAI_BATCH_WINDOW,
+                 max_size: int = AI_SETTINGS.OPENAI_BATCH_MAX_SIZE,
+                 poll_interval: float = AI_SETTINGS.OPENAI_BATCH_POLL_INTERVAL,
+                 max_poll_interval: float = AI_SETTINGS.OPENAI_BATCH_MAX_POLL_INTERVAL):
+        """
+        :param client: client of the provider supporting the Batch API
+        :param window: seconds to collect the requests before sending the batch
+        :param max_size: the batch is sent at once when it has that many requests
+        :param poll_interval: first status check delay, doubled after each check
+        :param max_poll_interval: max delay between the status checks
+        """
+        self.client = client
+        self.window = window
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._pending: Dict[str, Tuple[dict, asyncio.Future]] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._jobs: set[asyncio.Task] = set()
+
+    async def submit(self, completion_dict: dict) -> ChatCompletion:
+        """
+        Adds the request to the next batch and waits for its result.
+
+        :param completion_dict: chat.completions.create kwargs
+        :return: the completion as if it was a usual call
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending[uuid.uuid4().hex] = (batch_body(completion_dict), future)
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    def flush(self):
+        """
+        Sends the collected requests now.
+        """
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        self._flush_task = None
+        if not self._pending:
+            return
+        requests, self._pending = self._pending, {}
+        job = asyncio.create_task(self._run_batch(requests))
+        self._jobs.add(job)
+        job.add_done_callback(self._jobs.discard)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush()
+
+    async def _run_batch(self, requests: Dict[str, Tuple[dict, asyncio.Future]]):
+        try:
+            lines = [json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                                ensure_ascii=False)
+                     for custom_id, (body, _) in requests.items()]
+            input_file = await self.client.files.create(file=("kibernikto_batch.jsonl", "\n".join(lines).encode()),
+                                                        purpose="batch")
+            batch = await self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                                     completion_window="24h")
+            logger.info(f"batch {batch.id} with {len(requests)} requests sent")
+            batch = await self._wait(batch, requests)
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    content = await self.client.files.content(file_id)
+                    self._resolve(content.text, requests)
+            for _, future in requests.values():
+                if not future.done():
+                    future.set_exception(BatchError(f"batch {batch.id} is {batch.status}, no result for the request"))
+        except Exception as e:
+            logger.error(f"batch failed: {e}")
+            for _, future in requests.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for _, future in requests.values():
+                future.cancel()
+
+    async def _wait(self, batch: Batch, requests: Dict[str, Tuple[dict, asyncio.Future]]) -> Batch:
+        interval = self.poll_interval
+        while batch.status not in _FINAL_STATUSES:
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+            if all(future.done() for _, future in requests.values()):
+                # nobody waits for the answers anymore
+                logger.info(f"batch {batch.id} is abandoned, cancelling")
+                return await self.client.batches.cancel(batch.id)
+            batch = await self.client.batches.retrieve(batch.id)
+        logger.info(f"batch {batch.id} is {batch.status}: {batch.request_counts}")
+        return batch
+
+    @staticmethod
+    def _resolve(jsonl: str, requests: Dict[str, Tuple[dict, asyncio.Future]]):
+        for line in jsonl.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            request = requests.get(result.get('custom_id'))
+            if request is None or request[1].done():
+                continue
+            future = request[1]
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code', 200) >= 400:
+                error = result.get('error') or response.get('body', {}).get('error')
+                future.set_exception(BatchError(f"{error}"))
+            else:
+                future.set_result(ChatCompletion.model_validate(response['body']))
+
+    async def close(self):
+        """
+        Drops the collected requests and stops waiting for the sent batches, the callers get CancelledError.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        for _, future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        for job in list(self._jobs):
+            job.cancel()
+        await asyncio.gather(*self._jobs, return_exceptions=True)
+
+
+__SUBMITTERS: Dict[int, BatchSubmitter] = {}
+
+
+def get_batch_submitter(client: AsyncOpenAI) -> BatchSubmitter:
+    """
+    :return: the submitter collecting the batches for the client, one per client
+    """
+    submitter = __SUBMITTERS.get(id(client))
+    if submitter is None or submitter.client is not client:
+        submitter = BatchSubmitter(client)
+        __SUBMITTERS[id(client)] = submitter
+    return submitter
+
+
+def batch_stats() -> dict:
+    """
+    :return: requests waiting to be sent and batches waiting for the results
+    """
+    return dict(queue_depth=sum(len(submitter._pending) for submitter in __SUBMITTERS.values()),
+                running=sum(len(submitter._jobs) for submitter in __SUBMITTERS.values()))
+
+
+METRICS.register_stats("kibernikto_batch", batch_stats)
+
+
+async def close_batch_submitters():
+    submitters = list(__SUBMITTERS.values())
+    __SUBMITTERS.clear()
+    for submitter in submitters:
+        await submitter.close()
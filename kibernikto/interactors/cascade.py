@@ -0,0 +1,101 @@
+import re
+from typing import Dict, Literal
+
+from openai.types.chat.chat_completion import Choice
+
+from kibernikto.utils.metrics import METRICS
+
+# the small model says it when it should not answer itself
+ESCALATE_MARKER = "[ESCALATE]"
+
+CASCADE_INSTRUCTION = (f"If answering needs deep reasoning, precise facts you are not sure about, long code or "
+                       f"careful analysis, reply with exactly {ESCALATE_MARKER} and nothing else.")
+
+CLASSIFIER_REQUEST = ("Decide if a small fast model can answer the user message well or a strong model is needed. "
+                      "Small talk, thanks, simple facts and short answers are SIMPLE. Reasoning, code, analysis, "
+                      "math, long or multi-step tasks are COMPLEX. Reply with one word: SIMPLE or COMPLEX.")
+
+Route = Literal['small', 'main']
+
+_COMPLEX_PATTERN = re.compile(r"```|https?://|\n\s*\d+[.)]\s", re.IGNORECASE)
+
+
+def route_turn(text: str, recent_messages: list, simple_words: int, max_words: int,
+               additional_content: dict = None) -> Route | None:
+    """
+    Cheap heuristic routing of the user turn.
+
+    :param text: user message
+    :param recent_messages: the last history messages
+    :param simple_words: messages up to that many words go to the small model
+    :param max_words: messages longer than that go to the main model
+    :param additional_content: images etc
+    :return: the route or None if the heuristics can not decide
+    """
+    if additional_content:
+        return 'main'
+    if any(message.get('role') == 'tool' or message.get('tool_calls') for message in recent_messages):
+        # the conversation is in the middle of tool work
+        return 'main'
+    if _COMPLEX_PATTERN.search(text):
+        return 'main'
+    words = len(text.split())
+    if words > max_words:
+        return 'main'
+    if words <= simple_words:
+        return 'small'
+    return None
+
+
+def is_escalation(choice: Choice) -> bool:
+    """
+    If the small model answer should be thrown away in favour of the main model one.
+    """
+    if choice.finish_reason == 'length':
+        return True
+    content = (choice.message.content or "").strip()
+    if not content and not choice.message.tool_calls:
+        return True
+    return content.startswith(ESCALATE_MARKER)
+
+
+def merge_usage(first: dict | None, second: dict | None) -> dict | None:
+    """
+    Sums the tokens and costs of two calls made for one turn.
+    """
+    if not first or not second:
+        return second or first
+    merged = dict(second)
+    for key in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens',
+                'input_cost', 'output_cost', 'total_cost'):
+        if isinstance(first.get(key), (int, float)) and isinstance(second.get(key), (int, float)):
+            merged[key] = first[key] + second[key]
+    return merged
+
+
+class CascadeStats:
+    """
+    Turns, tokens and costs per cascade route.
+    """
+
+    def __init__(self):
+        self._routes: Dict[str, dict] = {}
+
+    def record(self, route: str, usage_dict: dict | None):
+        route_stats = self._routes.setdefault(route, dict(turns=0, prompt_tokens=0, completion_tokens=0,
+                                                          total_cost=0.0))
+        route_stats['turns'] += 1
+        if usage_dict:
+            route_stats['prompt_tokens'] += usage_dict.get('prompt_tokens') or 0
+            route_stats['completion_tokens'] += usage_dict.get('completion_tokens') or 0
+            route_stats['total_cost'] += usage_dict.get('total_cost') or 0.0
+
+    def stats(self) -> dict:
+        """
+        :return: routes usage: small, main, escalated (small model attempts given up) and classifier calls
+        """
+        return {route: dict(route_stats) for route, route_stats in self._routes.items()}
+
+
+CASCADE_STATS = CascadeStats()
+METRICS.register_stats("kibernikto_cascade", CASCADE_STATS.stats, label="route")
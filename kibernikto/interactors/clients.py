@@ -0,0 +1,57 @@
+import logging
+from typing import Dict, Tuple
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+
+logger = logging.getLogger("kibernikto.clients")
+
+# (base_url, api_key, max_retries, timeout) -> client
+__CLIENTS: Dict[Tuple, AsyncOpenAI] = {}
+
+
+def get_client(base_url: str | None, api_key: str | None, max_retries: int = AI_SETTINGS.OPENAI_MAX_RETRIES,
+               timeout: float | None = AI_SETTINGS.OPENAI_TIMEOUT) -> AsyncOpenAI:
+    """
+    Returns process-wide AsyncOpenAI client for the given connection params, creating it on the first call.
+    All the executors, agents and plugins talking to the same endpoint share one connection pool.
+
+    :param base_url: OpenAI compatible API url
+    :param api_key: API key
+    :param max_retries: client retries
+    :param timeout: request timeout in seconds, None for the library default
+    :return: shared client. Do not close it directly, use close_clients().
+    """
+    client_key = (base_url, api_key, max_retries, timeout)
+    client = __CLIENTS.get(client_key)
+    if client is None:
+        http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(
+            max_connections=AI_SETTINGS.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_SETTINGS.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AI_SETTINGS.OPENAI_KEEPALIVE_EXPIRY))
+        client_params = dict(base_url=base_url, api_key=api_key, max_retries=max_retries, http_client=http_client)
+        if timeout is not None:
+            client_params['timeout'] = timeout
+        client = AsyncOpenAI(**client_params)
+        __CLIENTS[client_key] = client
+        logger.debug(f"new shared client for {base_url}, {len(__CLIENTS)} in total")
+    return client
+
+
+def is_shared_client(client: AsyncOpenAI) -> bool:
+    return any(client is shared for shared in __CLIENTS.values())
+
+
+async def close_clients():
+    """
+    Closes all the shared clients. Safe to call several times.
+    """
+    clients = list(__CLIENTS.values())
+    __CLIENTS.clear()
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as e:
+            logger.error(f"failed to close the client {client.base_url}: {e}")
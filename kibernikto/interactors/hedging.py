@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+from pydantic import BaseModel
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.utils.metrics import METRICS
+
+logger = logging.getLogger("kibernikto.hedging")
+
+# latencies kept per endpoint to calculate the hedge delay
+LATENCY_WINDOW = 200
+
+
+class ExecutorEndpoint(BaseModel):
+    """
+    OpenAI compatible endpoint equivalent to the executor main one.
+    """
+    url: str
+    key: str | None = None  # executor key if not set
+    model: str | None = None  # name of the executor main model there, the same if not set
+    # names of the other models (summaries, cascade etc) there, not listed ones are not called there if model is set
+    models: Dict[str, str] = {}
+
+    def model_for(self, requested: str, main_model: str) -> str | None:
+        """
+        :param requested: model of the call
+        :param main_model: executor main model
+        :return: the model name to call there or None if the endpoint does not serve it
+        """
+        if requested in self.models:
+            return self.models[requested]
+        if not self.model:
+            return requested
+        return self.model if requested == main_model else None
+
+
+class EndpointLatency:
+    """
+    Recent latencies and outcomes of one endpoint and model.
+    """
+
+    def __init__(self):
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def percentile(self, q: float) -> float | None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class EndpointStats:
+    """
+    Latency statistics for all the endpoints, drives the hedge delays.
+    """
+
+    def __init__(self, percentile: float = AI_SETTINGS.OPENAI_HEDGE_PERCENTILE,
+                 default_delay: float = AI_SETTINGS.OPENAI_HEDGE_DEFAULT_DELAY,
+                 min_delay: float = AI_SETTINGS.OPENAI_HEDGE_MIN_DELAY,
+                 min_samples: int = 20):
+        """
+        :param percentile: the hedge is sent when the call is slower than this percentile of the endpoint latency
+        :param default_delay: hedge delay until the endpoint has enough samples
+        :param min_delay: never hedge earlier than that
+        :param min_samples: samples needed to trust the percentile
+        """
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._endpoints: Dict[Tuple[str, str, str], EndpointLatency] = {}
+
+    def get(self, endpoint: str, model: str, kind: str = 'complete') -> EndpointLatency:
+        stats_key = (f"{endpoint}", f"{model}", kind)
+        latency = self._endpoints.get(stats_key)
+        if latency is None:
+            latency = EndpointLatency()
+            self._endpoints[stats_key] = latency
+        return latency
+
+    def hedge_delay(self, endpoint: str, model: str, kind: str = 'complete') -> float:
+        latency = self.get(endpoint, model, kind)
+        if len(latency.latencies) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, latency.percentile(self.percentile))
+
+    def stats(self) -> dict:
+        """
+        :return: latency percentiles, errors, hedges sent from and races won per endpoint, model and call kind
+        """
+        return {f"{endpoint} {model} {kind}": {
+            "calls": latency.calls,
+            "errors": latency.errors,
+            "hedges": latency.hedges,
+            "wins": latency.wins,
+            "p50": latency.percentile(0.5),
+            "p95": latency.percentile(0.95)
+        } for (endpoint, model, kind), latency in self._endpoints.items()}
+
+
+ENDPOINT_STATS = EndpointStats()
+METRICS.register_stats("kibernikto_endpoint", ENDPOINT_STATS.stats, label="endpoint")
+
+
+def can_fail_over(error: BaseException) -> bool:
+    """
+    Errors another endpoint may not have: network, timeouts, overload and server side ones.
+    Bad requests would fail everywhere the same way.
+    """
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+async def hedged_call(attempts: List[Tuple[str, str, Callable[[], Awaitable]]], hedge: bool = True,
+                      kind: str = 'complete', discard: Callable[[object], Awaitable] = None):
+    """
+    Calls the first endpoint, sends the same call to the next one if the first is slower than usual
+    or fails, returns the first successful result and cancels the rest.
+
+    :param attempts: (endpoint url, model, call) in the order of preference
+    :param hedge: send the next call on slow responses, only on failures if False
+    :param kind: calls kind for the latency stats, streams opening and full completions differ a lot
+    :param discard: cleanup for the successful results that lost the race
+    :return: the winner result
+    """
+    pending: Dict[asyncio.Task, EndpointLatency] = {}
+    errors: List[BaseException] = []
+    launched = 0
+    winner = None
+
+    def launch():
+        nonlocal launched
+        endpoint, model, call = attempts[launched]
+        latency = ENDPOINT_STATS.get(endpoint, model, kind)
+        latency.calls += 1
+        pending[asyncio.ensure_future(_timed(latency, call))] = latency
+        launched += 1
+
+    launch()
+    try:
+        while pending:
+            timeout = None
+            if hedge and launched < len(attempts):
+                last_endpoint, last_model, _ = attempts[launched - 1]
+                timeout = ENDPOINT_STATS.hedge_delay(last_endpoint, last_model, kind)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info(f"{attempts[launched - 1][0]} is slow, hedging to {attempts[launched][0]}")
+                ENDPOINT_STATS.get(*attempts[launched - 1][:2], kind).hedges += 1
+                launch()
+                continue
+            for task in done:
+                latency = pending.pop(task)
+                error = task.exception()
+                if error is None:
+                    if winner is None:
+                        winner = task.result()
+                        latency.wins += 1
+                    elif discard:
+                        await discard(task.result())
+                    continue
+                latency.errors += 1
+                if not can_fail_over(error):
+                    raise error
+                errors.append(error)
+            if winner is not None:
+                return winner
+            if launched < len(attempts) and len(pending) == 0:
+                logger.warning(f"{attempts[launched - 1][0]} failed: {errors[-1]}, failing over to {attempts[launched][0]}")
+                launch()
+        raise errors[0]
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            losers = await asyncio.gather(*pending, return_exceptions=True)
+            if discard:
+                for result in losers:
+                    if not isinstance(result, BaseException):
+                        await discard(result)
+
+
+async def _timed(latency: EndpointLatency, call: Callable[[], Awaitable]):
+    start = time.monotonic()
+    result = await call()
+    latency.latencies.append(time.monotonic() - start)
+    return result
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import zlib
+from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+
+logger = logging.getLogger("kibernikto.history")
+
+_COMPRESS_FROM_BYTES = 512
+
+
+class HistoryStore(ABC):
+    """
+    Persistent conversations storage. Writes must not block the caller: they are expected to be buffered.
+    """
+
+    @abstractmethod
+    async def load(self, key: str, limit: int) -> List[dict]:
+        """
+        :param key: conversation key
+        :param limit: max number of the latest messages to load
+        :return: messages in chronological order
+        """
+        pass
+
+    async def load_conversation(self, key: str, limit: int) -> Tuple[List[dict], str | None]:
+        """
+        :param key: conversation key
+        :param limit: max number of the latest messages to load
+        :return: the messages not folded into the summary and the summary, None if there is no summary
+        """
+        return await self.load(key, limit), None
+
+    @abstractmethod
+    def append(self, key: str, message: dict):
+        pass
+
+    @abstractmethod
+    def clear(self, key: str):
+        pass
+
+    def set_summary(self, key: str, summary: str, kept: int):
+        """
+        Folds all the conversation messages but the latest ones into the summary.
+        Stores not supporting summaries keep the messages as they are.
+
+        :param key: conversation key
+        :param summary: summary of the folded messages
+        :param kept: number of the latest messages not folded
+        """
+        pass
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def _json_default(value):
+    if hasattr(value, 'model_dump'):
+        return value.model_dump(mode="json")
+    return str(value)
+
+
+def pack_message(message: dict) -> tuple[bytes, int]:
+    data = json.dumps(message, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+    if len(data) >= _COMPRESS_FROM_BYTES:
+        return zlib.compress(data), 1
+    return data, 0
+
+
+def unpack_message(data: bytes, compressed: int) -> dict:
+    if compressed:
+        data = zlib.decompress(data)
+    return json.loads(data)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Default HistoryStore implementation based on aiosqlite.
+    Appends are collected in memory and written in batches by a background task.
+    """
+
+    def __init__(self, db_path: str, flush_interval: float = AI_SETTINGS.OPENAI_HISTORY_FLUSH_INTERVAL,
+                 max_batch: int = 500, keep_messages: int = AI_SETTINGS.OPENAI_HISTORY_KEEP_MESSAGES):
+        """
+        :param db_path: sqlite database file
+        :param flush_interval: seconds between the batched writes
+        :param max_batch: pending operations count to flush immediately
+        :param keep_messages: messages to keep per conversation, older ones are deleted
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.keep_messages = keep_messages
+        self._db = None
+        self._pending: list[tuple] = []
+        self._flusher: asyncio.Task | None = None
+        self._flush_needed = None
+        self._lock = None
+
+    async def _get_db(self):
+        if self._db is None:
+            import aiosqlite
+
+            self._db = await aiosqlite.connect(self.db_path)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute("PRAGMA synchronous=NORMAL")
+            await self._db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                                   "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                   "chat_key TEXT NOT NULL, "
+                                   "data BLOB NOT NULL, "
+                                   "compressed INTEGER NOT NULL DEFAULT 0)")
+            await self._db.execute("CREATE INDEX IF NOT EXISTS messages_chat_key ON messages (chat_key, id)")
+            # messages up to folded_until are replaced by the summary
+            await self._db.execute("CREATE TABLE IF NOT EXISTS summaries ("
+                                   "chat_key TEXT PRIMARY KEY, "
+                                   "summary TEXT NOT NULL, "
+                                   "folded_until INTEGER NOT NULL)")
+            await self._db.commit()
+        return self._db
+
+    async def load(self, key: str, limit: int) -> List[dict]:
+        messages, _ = await self.load_conversation(key, limit)
+        return messages
+
+    async def load_conversation(self, key: str, limit: int) -> Tuple[List[dict], str | None]:
+        # not flushing: other chats writes do not delay the load, this chat pending ones are taken from memory
+        async with self._get_lock():
+            db = await self._get_db()
+            async with db.execute("SELECT summary, folded_until FROM summaries WHERE chat_key = ?",
+                                  (key,)) as cursor:
+                summary_row = await cursor.fetchone()
+            summary, folded_until = summary_row if summary_row else (None, 0)
+            async with db.execute("SELECT data, compressed FROM messages WHERE chat_key = ? AND id > ? "
+                                  "ORDER BY id DESC LIMIT ?", (key, folded_until, limit)) as cursor:
+                rows = await cursor.fetchall()
+            messages = [unpack_message(data, compressed) for data, compressed in reversed(rows)]
+            for operation in self._pending:
+                if operation[1] != key:
+                    continue
+                if operation[0] == "append":
+                    messages.append(unpack_message(operation[2], operation[3]))
+                elif operation[0] == "summary":
+                    summary, kept = operation[2], operation[3]
+                    messages = messages[max(0, len(messages) - kept):] if kept else []
+                else:
+                    messages, summary = [], None
+        return (messages[-limit:] if limit else messages), summary
+
+    def append(self, key: str, message: dict):
+        data, compressed = pack_message(message)
+        self._schedule(("append", key, data, compressed))
+
+    def clear(self, key: str):
+        self._schedule(("clear", key))
+
+    def set_summary(self, key: str, summary: str, kept: int):
+        self._schedule(("summary", key, summary, kept))
+
+    def _schedule(self, operation: tuple):
+        self._pending.append(operation)
+        if self._flusher is None or self._flusher.done():
+            self._flush_needed = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.max_batch:
+            self._flush_needed.set()
+
+    async def _flush_loop(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"failed to write the history batch: {e}", exc_info=True)
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def flush(self):
+        async with self._get_lock():
+            if not self._pending:
+                return
+            # the operations stay pending until committed, so a failed batch is retried as a whole
+            operations = self._pending[:]
+            db = await self._get_db()
+            try:
+                touched_keys = set()
+                rows = []
+                for operation in operations:
+                    if operation[0] == "append":
+                        rows.append(operation[1:])
+                        touched_keys.add(operation[1])
+                        continue
+                    if rows:
+                        await db.executemany("INSERT INTO messages (chat_key, data, compressed) VALUES (?, ?, ?)",
+                                             rows)
+                        rows = []
+                    if operation[0] == "summary":
+                        await self._write_summary(db, *operation[1:])
+                        continue
+                    await db.execute("DELETE FROM messages WHERE chat_key = ?", (operation[1],))
+                    await db.execute("DELETE FROM summaries WHERE chat_key = ?", (operation[1],))
+                if rows:
+                    await db.executemany("INSERT INTO messages (chat_key, data, compressed) VALUES (?, ?, ?)", rows)
+                if self.keep_messages:
+                    await db.executemany("DELETE FROM messages WHERE chat_key = ? AND id <= "
+                                         "(SELECT id FROM messages WHERE chat_key = ? "
+                                         "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                                         [(key, key, self.keep_messages) for key in touched_keys])
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+            del self._pending[:len(operations)]
+            logger.debug(f"{len(operations)} history operations written")
+
+    @staticmethod
+    async def _write_summary(db, key: str, summary: str, kept: int):
+        # the last folded message is the one before the kept ones
+        async with db.execute("SELECT id FROM messages WHERE chat_key = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                              (key, kept)) as cursor:
+            row = await cursor.fetchone()
+        await db.execute("INSERT INTO summaries (chat_key, summary, folded_until) VALUES (?, ?, ?) "
+                         "ON CONFLICT(chat_key) DO UPDATE SET summary = excluded.summary, "
+                         "folded_until = MAX(folded_until, excluded.folded_until)",
+                         (key, summary, row[0] if row else 0))
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+
+__HISTORY_STORE: HistoryStore | None = None
+
+
+def get_history_store() -> HistoryStore | None:
+    """
+    :return: process-wide history store, None if conversations are not persisted (OPENAI_HISTORY_DB is not set).
+    """
+    global __HISTORY_STORE
+    if __HISTORY_STORE is None and AI_SETTINGS.OPENAI_HISTORY_DB:
+        __HISTORY_STORE = SQLiteHistoryStore(db_path=AI_SETTINGS.OPENAI_HISTORY_DB)
+    return __HISTORY_STORE
+
+
+def set_history_store(store: HistoryStore | None):
+    """
+    Plugs a custom history store in. Has to be called before executors creation.
+    """
+    global __HISTORY_STORE
+    __HISTORY_STORE = store
+
+
+async def close_history_store():
+    global __HISTORY_STORE
+    if __HISTORY_STORE is not None:
+        store, __HISTORY_STORE = __HISTORY_STORE, None
+        await store.close()
@@ -0,0 +1,188 @@
+import sys
+import zlib
+from collections import deque
+from itertools import islice
+from typing import Iterable, Iterator
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.utils.memory import deep_size
+from kibernikto.utils.tokens import estimate_message_tokens, count_words
+
+# shorter contents are not worth compressing
+COMPRESS_MIN_LENGTH = 512
+
+_NO_CONTENT = object()
+
+
+class MessageRecord:
+    """
+    Compact history message: interned role, content (zlib compressed when cold) and the cached sizes.
+    Rare fields like tool_calls live in the extra dict. Becomes an OpenAI message dict only when sent:
+    decompressing takes ~20µs for 4KB of text, so compression trades a little CPU per turn for memory.
+    """
+    __slots__ = ('role', 'content', 'tokens', 'words', 'extra')
+
+    def __init__(self, message: dict):
+        self.role = sys.intern(message['role'])
+        self.content = message.get('content', _NO_CONTENT)
+        self.tokens = estimate_message_tokens(message)
+        self.words = count_words(message)
+        extra = {key: value for key, value in message.items() if key != 'role' and key != 'content'}
+        self.extra = extra or None
+
+    def compress(self) -> int:
+        """
+        :return: bytes saved
+        """
+        if isinstance(self.content, str) and len(self.content) >= COMPRESS_MIN_LENGTH:
+            size = sys.getsizeof(self.content)
+            self.content = zlib.compress(self.content.encode('utf-8'))
+            return size - sys.getsizeof(self.content)
+        return 0
+
+    def to_dict(self) -> dict:
+        """
+        :return: a new message dict
+        """
+        message = {'role': self.role}
+        if isinstance(self.content, bytes):
+            message['content'] = zlib.decompress(self.content).decode('utf-8')
+        elif self.content is not _NO_CONTENT:
+            message['content'] = self.content
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+    def content_size(self) -> int:
+        """
+        :return: bytes the content takes
+        """
+        if isinstance(self.content, (str, bytes)):
+            return len(self.content)
+        return 0 if self.content is _NO_CONTENT or self.content is None else len(str(self.content))
+
+    def memory_size(self) -> int:
+        """
+        :return: approximate bytes the record takes with its content and extra fields
+        """
+        size = sys.getsizeof(self)
+        if self.content is not _NO_CONTENT:
+            size += deep_size(self.content)
+        if self.extra:
+            size += deep_size(self.extra)
+        return size
+
+
+class MessageHistory:
+    """
+    Executor dialogue history. Works like a deque of OpenAI message dicts,
+    but keeps compact MessageRecords inside with cached token, word and memory counts, so budget checks cost nothing.
+    Indexing, iterating and popping give out copies of the messages: changing them does not change the history.
+    Also tracks the first user message: the prompt can not start with anything else.
+    """
+
+    def __init__(self, messages: Iterable[dict] = (), maxlen: int | None = None,
+                 compress_cold: bool = AI_SETTINGS.OPENAI_HISTORY_COMPRESS,
+                 hot_messages: int = AI_SETTINGS.OPENAI_HISTORY_HOT_MESSAGES):
+        """
+        :param messages: initial messages
+        :param maxlen: max messages, the oldest are dropped
+        :param compress_cold: compress the contents of all the messages but the last hot_messages
+        :param hot_messages: latest messages kept as is
+        """
+        self._maxlen = maxlen
+        self._records: deque[MessageRecord] = deque()
+        self.compress_cold = compress_cold
+        self.hot_messages = hot_messages
+        self.total_tokens = 0
+        self.total_words = 0
+        self.memory_bytes = 0
+        # absolute positions: messages popped so far and the first user message
+        self._popped = 0
+        self._first_user: int | None = None
+        self.extend(messages)
+
+    @property
+    def maxlen(self) -> int | None:
+        return self._maxlen
+
+    @property
+    def first_position(self) -> int:
+        """
+        Absolute position of the first message: grows with every popleft.
+        """
+        return self._popped
+
+    def append(self, message: dict):
+        if self._maxlen is not None and len(self._records) >= self._maxlen:
+            self.popleft()
+        record = MessageRecord(message)
+        if self._first_user is None and record.role == 'user':
+            self._first_user = self._popped + len(self._records)
+        self._records.append(record)
+        self.total_tokens += record.tokens
+        self.total_words += record.words
+        self.memory_bytes += record.memory_size()
+        if self.compress_cold and len(self._records) > self.hot_messages:
+            self.memory_bytes -= self._records[-self.hot_messages - 1].compress()
+
+    def extend(self, messages: Iterable[dict]):
+        for message in messages:
+            self.append(message)
+
+    def popleft(self) -> dict:
+        record = self._records.popleft()
+        self.total_tokens -= record.tokens
+        self.total_words -= record.words
+        self.memory_bytes -= record.memory_size()
+        self._popped += 1
+        if self._first_user is not None and self._first_user < self._popped:
+            self._first_user = next((self._popped + i for i, left in enumerate(self._records)
+                                     if left.role == 'user'), None)
+        return record.to_dict()
+
+    def token_count(self, index: int) -> int:
+        return self._records[index].tokens
+
+    def role(self, index: int) -> str:
+        return self._records[index].role
+
+    def from_first_user(self) -> Iterator[dict]:
+        """
+        :return: the messages valid to start the prompt with, built when the prompt is
+        """
+        if self._first_user is None:
+            return iter(())
+        return (record.to_dict() for record in islice(self._records, self._first_user - self._popped, None))
+
+    def content_bytes(self) -> int:
+        """
+        :return: approximate bytes taken by the contents
+        """
+        return sum(record.content_size() for record in self._records)
+
+    def clear(self):
+        self._records.clear()
+        self.total_tokens = 0
+        self.total_words = 0
+        self.memory_bytes = 0
+        self._popped = 0
+        self._first_user = None
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[dict]:
+        return (record.to_dict() for record in self._records)
+
+    def __getitem__(self, index: int) -> dict:
+        """
+        :return: a copy of the message: changing it does not change the history
+        """
+        return self._records[index].to_dict()
+
+    def __bool__(self) -> bool:
+        return bool(self._records)
+
+    def __repr__(self):
+        return f"MessageHistory({len(self)} messages, ~{self.total_tokens} tokens)"
@@ -1,21 +1,44 @@
+import asyncio
 import logging
-from collections import deque
+import time
+from contextlib import AsyncExitStack
 from enum import Enum
-from typing import List, Literal
+from functools import partial
+from typing import List, Literal, AsyncIterator
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, AsyncStream
 from openai._types import NOT_GIVEN
 from openai.types import CompletionUsage
-from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage, ChatCompletionChunk
 from openai.types.chat.chat_completion import Choice
 from pydantic import BaseModel
 
 from kibernikto.bots.ai_settings import AI_SETTINGS
-from kibernikto.interactors.tools import Toolbox
+from kibernikto.interactors.tools import Toolbox, ToolRegistry, get_tool_registry
 from kibernikto.utils import ai_tools
 from kibernikto.utils.ai_tools import run_tool_calls
+from kibernikto.utils.metrics import METRICS, SLOW_BUCKETS
+from .clients import get_client
+from .batch import get_batch_submitter
+from .cascade import CASCADE_STATS, CASCADE_INSTRUCTION, CLASSIFIER_REQUEST, Route, route_turn, is_escalation, \
+    merge_usage
+from .hedging import ExecutorEndpoint, hedged_call
+from .history_store import HistoryStore, get_history_store
+from .message_history import MessageHistory
+from .prompt_builder import Prompt, PromptBuilder
+from .response_cache import RESPONSE_CACHE, REQUEST_FLIGHTS, completion_cache_key
+from .rate_limiter import RATE_LIMITER
+from .scheduler import LLM_SCHEDULER, Priority, current_turn_priority
 from .openai_executor_utils import get_tool_implementation, calculate_max_messages, process_usage, has_pricing, \
-    prepare_message_prompt, check_word_overflow
+    prepare_message_prompt, add_cache_usage
+
+LLM_SECONDS = METRICS.histogram("kibernikto_llm_request_seconds",
+                                "LLM call time till the full answer, scheduler and rate limit waits included",
+                                labels=("model", "kind"), buckets=SLOW_BUCKETS)
+LLM_FIRST_TOKEN_SECONDS = METRICS.histogram("kibernikto_llm_first_token_seconds",
+                                            "Streamed LLM call time till the first token, waiting included",
+                                            labels=("model",), buckets=SLOW_BUCKETS)
+LLM_ERRORS = METRICS.counter("kibernikto_llm_errors_total", "Failed LLM calls", labels=("model", "kind"))
 
 
 class OpenAiExecutorConfig(BaseModel):
@@ -37,6 +60,24 @@ class OpenAiExecutorConfig(BaseModel):
     master_call: str = "Mister kibernikto!"
     summarize_request: str | None = AI_SETTINGS.OPENAI_SUMMARY
     max_words_before_summary: int = AI_SETTINGS.OPENAI_MAX_WORDS
+    max_history_tokens: int = AI_SETTINGS.OPENAI_MAX_HISTORY_TOKENS
+    summary_model: str | None = AI_SETTINGS.OPENAI_SUMMARY_MODEL
+    summary_threshold_tokens: int = AI_SETTINGS.OPENAI_SUMMARY_THRESHOLD_TOKENS
+    response_cache: bool = AI_SETTINGS.OPENAI_RESPONSE_CACHE
+    prompt_cache: bool = AI_SETTINGS.OPENAI_PROMPT_CACHE
+    prompt_cache_key: str | None = None  # executor history key if not set
+    prompt_cache_key_field: Literal['prompt_cache_key', 'user'] = AI_SETTINGS.OPENAI_PROMPT_CACHE_KEY_FIELD
+    # equivalent endpoints to use when the main one fails or is slow
+    fallback_endpoints: List[ExecutorEndpoint] = [ExecutorEndpoint(**endpoint) for endpoint in
+                                                  AI_SETTINGS.OPENAI_FALLBACK_ENDPOINTS]
+    hedge_requests: bool = AI_SETTINGS.OPENAI_HEDGE_REQUESTS
+    # small model answering simple turns, the main one gets the rest
+    cascade_model: str | None = AI_SETTINGS.OPENAI_CASCADE_MODEL
+    cascade_classifier: bool = AI_SETTINGS.OPENAI_CASCADE_CLASSIFIER
+    cascade_simple_words: int = AI_SETTINGS.OPENAI_CASCADE_SIMPLE_WORDS
+    cascade_max_words: int = AI_SETTINGS.OPENAI_CASCADE_MAX_WORDS
+    # small model to summarize the tool results over the budget instead of cutting them
+    tool_result_summary_model: str | None = AI_SETTINGS.OPENAI_TOOLS_SUMMARY_MODEL
     tool_call_hole_deepness: int = AI_SETTINGS.OPENAI_TOOLS_DEEPNESS_LEVEL
     reaction_calls: list = ['никто', 'honda', 'кибер']
     tools: List[Toolbox] = []
@@ -47,6 +88,26 @@ class OpenAiExecutorConfig(BaseModel):
 
 DEFAULT_CONFIG = OpenAiExecutorConfig()
 
+# part of the history limits left after a cut in prompt cache mode
+PROMPT_CACHE_TRIM_RATIO = 0.5
+
+_DEFAULT_SUMMARY_REQUEST = ("Summarize the conversation below. Keep names, facts, numbers, decisions, user preferences "
+                            "and open questions, drop the small talk. If there is a previous summary, merge it in. "
+                            "Reply with the summary only, in the language of the conversation.")
+
+
+def _text_content(message: dict) -> str:
+    """
+    :return: the text of the message, images and other non-text parts skipped
+    """
+    content = message.get('content')
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(part.get('text') or '' for part in content
+                         if isinstance(part, dict) and part.get('type') == 'text')
+    return ''
+
 
 class OpenAIRoles(str, Enum):
     system = 'system',
@@ -75,7 +136,7 @@ class OpenAIExecutor:
             self.client = client
             self.restrict_client_instance = True
         else:
-            self.client = AsyncOpenAI(base_url=config.url, api_key=config.key, max_retries=DEFAULT_CONFIG.max_retries)
+            self.client = get_client(base_url=config.url, api_key=config.key, max_retries=config.max_retries)
             self.restrict_client_instance = False
 
         self.model = config.model
@@ -86,16 +147,40 @@ class OpenAIExecutor:
 
         # additional tools in Toolbox formats
         self.tools: List[Toolbox] = config.tools
+        self._tool_registry: ToolRegistry | None = None
+        self._tool_registry_for: tuple = ()
         self.use_system = True
 
         if self.max_messages < 2:
             self.max_messages = 2  # hahaha
 
+        # default LLM calls scheduling class, the outer code sets it per turn with turn_priority()
+        self.priority: Priority = Priority.private
+        # monotonic time of the last use: refreshed by the outer code and by every message saved
+        self.last_active = time.monotonic()
+
+        self.prompt_builder = PromptBuilder()
+
+        # uncut tool results of the current turn by tool call id, the history gets the compacted ones
+        self.turn_tool_results: dict = {}
+
+        # persistent history, is loaded lazily on the first request
+        self.history_store: HistoryStore | None = get_history_store() if unique_id is not NOT_GIVEN else None
+
         self._reset()
 
+    @property
+    def tool_registry(self) -> ToolRegistry:
+        # held by the executor, so the shared registry goes away with the last executor using it
+        if self._tool_registry is None or len(self.tools) != len(self._tool_registry_for) or any(
+                a is not b for a, b in zip(self.tools, self._tool_registry_for)):
+            self._tool_registry = get_tool_registry(self.tools)
+            self._tool_registry_for = tuple(self.tools)
+        return self._tool_registry
+
     @property
     def tools_definitions(self):
-        return [toolbox.definition for toolbox in self.tools]
+        return self.tool_registry.definitions
 
     @property
     def default_headers(self):
@@ -105,12 +190,19 @@ class OpenAIExecutor:
     def extra_body(self):
         return None
 
+    @property
+    def history_key(self) -> str:
+        """
+        key to store this executor conversation with
+        """
+        return f"{self.unique_id}"
+
     @property
     def tools_names(self):
-        return [toolbox.function_name for toolbox in self.tools]
+        return self.tool_registry.names
 
     def _get_tool_implementation(self, name):
-        return get_tool_implementation(self)
+        return get_tool_implementation(self, name)
 
     def _set_max_history_len(self, config: OpenAiExecutorConfig):
         self.max_messages = calculate_max_messages(config)
@@ -127,7 +219,7 @@ class OpenAIExecutor:
         usage_dict = usage.model_dump()
         if has_pricing(self.full_config):
             usage_dict = process_usage(usage_dict, self)
-        return usage_dict
+        return add_cache_usage(usage_dict, usage)
 
     def should_react(self, message_text):
         """
@@ -141,6 +233,47 @@ class OpenAIExecutor:
 
     async def single_request(self, message, model=None, response_type: Literal['text', 'json_object'] = 'text',
                              additional_content: dict = None, max_tokens=None, temperature=None, use_system=True):
+        completion_dict = self._build_single_request_dict(message, model=model, response_type=response_type,
+                                                          additional_content=additional_content,
+                                                          max_tokens=max_tokens, temperature=temperature,
+                                                          use_system=use_system)
+
+        cache_key = None
+        if self.full_config.response_cache or AI_SETTINGS.OPENAI_COALESCE_REQUESTS:
+            cache_key = completion_cache_key(self.full_config.url, completion_dict)
+        if self.full_config.response_cache:
+            cached = RESPONSE_CACHE.get(cache_key, None)
+            if cached is not None:
+                # nothing was spent
+                return cached, dict(prompt_tokens=0, completion_tokens=0, total_tokens=0, response_cache_hit=True)
+
+        led = False
+
+        async def create_completion():
+            nonlocal led
+            led = True
+            return await self._create_completion(completion_dict)
+
+        if AI_SETTINGS.OPENAI_COALESCE_REQUESTS:
+            # only the calls paid by the same key are shared
+            completion: ChatCompletion = await REQUEST_FLIGHTS.do((self.full_config.key, cache_key),
+                                                                  create_completion)
+        else:
+            completion: ChatCompletion = await create_completion()
+        choice: Choice = completion.choices[0]
+        if led:
+            usage_dict = self.process_usage(completion.usage)
+        else:
+            # the call is paid by the executor that led it
+            usage_dict = dict(prompt_tokens=0, completion_tokens=0, total_tokens=0, coalesced=True)
+        if self.full_config.response_cache and choice.finish_reason != 'length':
+            RESPONSE_CACHE.set(cache_key, choice)
+        return choice, usage_dict
+
+    def _build_single_request_dict(self, message, model=None,
+                                   response_type: Literal['text', 'json_object'] = 'text',
+                                   additional_content: dict = None, max_tokens=None, temperature=None,
+                                   use_system=True) -> dict:
         this_message = dict(content=f"{message}", role=OpenAIRoles.user.value)
 
         if additional_content:
@@ -176,14 +309,28 @@ class OpenAIExecutor:
             completion_dict['max_completion_tokens'] = max_output_tokens
 
         completion_dict['messages'] = messages
+        return completion_dict
 
-        completion: ChatCompletion = await self.client.chat.completions.create(**completion_dict)
-        choice: Choice = completion.choices[0]
+    async def batch_request(self, message, model=None, response_type: Literal['text', 'json_object'] = 'text',
+                            additional_content: dict = None, max_tokens=None, temperature=None, use_system=True):
+        """
+        single_request going through the provider Batch API: twice cheaper, but the answer may take hours.
+        For bulk offline jobs only. Concurrent calls are collected into one batch.
+
+        :return: choice and usage dict as single_request does
+        """
+        completion_dict = self._build_single_request_dict(message, model=model, response_type=response_type,
+                                                          additional_content=additional_content,
+                                                          max_tokens=max_tokens, temperature=temperature,
+                                                          use_system=use_system)
+        completion: ChatCompletion = await get_batch_submitter(self.client).submit(completion_dict)
         usage_dict = self.process_usage(completion.usage)
-        return choice, usage_dict
+        if usage_dict is not None:
+            usage_dict['batch'] = True
+        return completion.choices[0], usage_dict
 
-    async def _run_for_messages(self, full_prompt, author=NOT_GIVEN,
-                                response_type: Literal['text', 'json_object'] = 'text', model: str = None):
+    def _build_completion_dict(self, full_prompt, response_type: Literal['text', 'json_object'] = 'text',
+                               model: str = None) -> dict:
         tools_to_use = self.tools_definitions if self.tools_definitions else NOT_GIVEN
 
         if not full_prompt:
@@ -192,12 +339,18 @@ class OpenAIExecutor:
         if not model:
             model = self.model
 
-        # Need to be sure the prompt is fine
-        system_message = [full_prompt[0]] if full_prompt[0]['role'] == 'system' else []
         response_format = {"type": response_type}
-        conversation_messages = full_prompt[1:] if system_message else full_prompt
-        # can not start with tool result, for example
-        filtered_messages = prepare_message_prompt(conversation_messages)
+        if isinstance(full_prompt, Prompt):
+            # checked while building
+            has_system = full_prompt.has_system
+            checked_prompt = full_prompt
+        else:
+            # Need to be sure the prompt is fine
+            has_system = full_prompt[0]['role'] == 'system'
+            system_message = [full_prompt[0]] if has_system else []
+            conversation_messages = full_prompt[1:] if has_system else full_prompt
+            # can not start with tool result, for example
+            checked_prompt = system_message + prepare_message_prompt(conversation_messages)
 
         completion_dict = dict(
             model=model,
@@ -210,18 +363,31 @@ class OpenAIExecutor:
         if self.extra_body:
             completion_dict['extra_body'] = self.extra_body
 
+        if self.full_config.prompt_cache:
+            # same key for the same chat: the provider routes it to the same cache
+            cache_key = self.full_config.prompt_cache_key or f"{self.full_config.app_id}:{self.history_key}"
+            if self.full_config.prompt_cache_key_field == 'user':
+                completion_dict['user'] = cache_key
+            else:
+                completion_dict['extra_body'] = {**(self.extra_body or {}), 'prompt_cache_key': cache_key}
+
         if self.use_system:
-            final_prompt = system_message + filtered_messages
+            final_prompt = checked_prompt
             completion_dict['max_tokens'] = self.full_config.max_tokens
             completion_dict['temperature'] = self.full_config.temperature
         else:
-            final_prompt = filtered_messages
+            final_prompt = checked_prompt[1:] if has_system else checked_prompt
             completion_dict['max_completion_tokens'] = self.full_config.max_tokens * 5
 
         completion_dict['messages'] = final_prompt
+        return completion_dict
+
+    async def _run_for_messages(self, full_prompt, author=NOT_GIVEN,
+                                response_type: Literal['text', 'json_object'] = 'text', model: str = None):
+        completion_dict = self._build_completion_dict(full_prompt, response_type=response_type, model=model)
 
         try:
-            completion: ChatCompletion = await self.client.chat.completions.create(**completion_dict)
+            completion: ChatCompletion = await self._create_completion(completion_dict)
         except Exception as e:
             # pprint.pprint(f"{final_prompt}")
             raise e
@@ -230,9 +396,148 @@ class OpenAIExecutor:
         usage_dict = self.process_usage(completion.usage)
         return choice, usage_dict
 
+    async def _create_completion(self, completion_dict: dict, priority: Priority = None) -> ChatCompletion:
+        """
+        All the executor LLM calls go here: waiting for the scheduler slot and the rate limit and calling the API.
+        Fails over or hedges to the fallback endpoints if there are any.
+        """
+        if priority is None:
+            priority = self._turn_priority()
+        if not self.full_config.fallback_endpoints:
+            return await self._call_endpoint(self.client, self.full_config.url, completion_dict, priority)
+        attempts = [(url, endpoint_dict['model'], partial(self._call_endpoint, client, url, endpoint_dict, priority))
+                    for client, url, endpoint_dict in self._endpoints(completion_dict)]
+        return await hedged_call(attempts, hedge=self.full_config.hedge_requests)
+
+    def _turn_priority(self) -> Priority:
+        turn_priority = current_turn_priority()
+        return self.priority if turn_priority is None else turn_priority
+
+    async def _call_endpoint(self, client: AsyncOpenAI, url: str, completion_dict: dict,
+                             priority: Priority) -> ChatCompletion:
+        start = time.perf_counter()
+        async with LLM_SCHEDULER.slot(url, completion_dict['model'], priority=priority, chat_key=self.history_key):
+            try:
+                completion = await RATE_LIMITER.create(client, url, completion_dict)
+            except Exception:
+                LLM_ERRORS.inc(completion_dict['model'], 'complete')
+                raise
+            LLM_SECONDS.observe(time.perf_counter() - start, completion_dict['model'], 'complete')
+            return completion
+
+    async def _open_stream(self, client: AsyncOpenAI, url: str, completion_dict: dict,
+                           priority: Priority) -> tuple[AsyncStream[ChatCompletionChunk], AsyncExitStack]:
+        """
+        Opens the stream keeping the scheduler slot.
+
+        :return: the stream and the exit stack closing the stream and freeing the slot
+        """
+        stack = AsyncExitStack()
+        await stack.enter_async_context(LLM_SCHEDULER.slot(url, completion_dict['model'], priority=priority,
+                                                           chat_key=self.history_key))
+        try:
+            stream: AsyncStream[ChatCompletionChunk] = await RATE_LIMITER.create(client, url, completion_dict)
+        except BaseException:
+            await stack.aclose()
+            raise
+        stack.push_async_callback(stream.close)
+        return stream, stack
+
+    def _endpoints(self, completion_dict: dict) -> list[tuple[AsyncOpenAI, str, dict]]:
+        """
+        :return: (client, url, completion dict) for the main endpoint and the fallback ones
+        """
+        endpoints = [(self.client, self.full_config.url, completion_dict)]
+        for endpoint in self.full_config.fallback_endpoints:
+            model = endpoint.model_for(completion_dict['model'], self.full_config.model)
+            if model is None:
+                continue
+            client = get_client(base_url=endpoint.url, api_key=endpoint.key or self.full_config.key,
+                                max_retries=self.full_config.max_retries)
+            if model != completion_dict['model']:
+                endpoint_dict = {**completion_dict, 'model': model}
+            else:
+                endpoint_dict = completion_dict
+            endpoints.append((client, endpoint.url, endpoint_dict))
+        return endpoints
+
+    async def _stream_for_messages(self, full_prompt, model: str = None) -> AsyncIterator[str | tuple]:
+        """
+        Streaming version of _run_for_messages.
+        Yields text deltas as soon as they arrive and the assembled (choice, usage) tuple as the very last item.
+        """
+        completion_dict = self._build_completion_dict(full_prompt, model=model)
+        completion_dict['stream'] = True
+        completion_dict['stream_options'] = {"include_usage": True}
+
+        content_parts = []
+        tool_calls: dict[int, dict] = {}
+        finish_reason = None
+        usage = None
+        model = completion_dict['model']
+        start = time.perf_counter()
+        first_token = True
+
+        if not self.full_config.fallback_endpoints:
+            stream, stack = await self._open_stream(self.client, self.full_config.url, completion_dict,
+                                                    self._turn_priority())
+        else:
+            priority = self._turn_priority()
+            attempts = [(url, endpoint_dict['model'], partial(self._open_stream, client, url, endpoint_dict, priority))
+                        for client, url, endpoint_dict in self._endpoints(completion_dict)]
+            stream, stack = await hedged_call(attempts, hedge=self.full_config.hedge_requests, kind='stream',
+                                              discard=lambda opened: opened[1].aclose())
+
+        # the call takes the slot until the stream is over
+        async with stack:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                chunk_choice = chunk.choices[0]
+                if chunk_choice.finish_reason:
+                    finish_reason = chunk_choice.finish_reason
+                delta = chunk_choice.delta
+                if first_token and (delta.content or delta.tool_calls):
+                    first_token = False
+                    LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start, model)
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield delta.content
+                if delta.tool_calls:
+                    ai_tools.merge_tool_call_deltas(tool_calls, delta.tool_calls)
+        LLM_SECONDS.observe(time.perf_counter() - start, model, 'stream')
+
+        choice = ai_tools.assemble_streamed_choice(content="".join(content_parts), tool_calls=tool_calls,
+                                                   finish_reason=finish_reason)
+        yield choice, self.process_usage(usage)
+
     async def heed_and_reply(self, **kwargs):
         return await self.request_llm(**kwargs)
 
+    async def heed_and_reply_stream(self, **kwargs) -> AsyncIterator[str]:
+        async for delta in self.request_llm_stream(**kwargs):
+            yield delta
+
+    def _make_user_message(self, user_message: str, additional_content: dict = None) -> dict:
+        if additional_content:
+            return {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": user_message},
+                    additional_content
+                ]
+            }
+        return dict(content=f"{user_message}", role=OpenAIRoles.user.value)
+
+    async def _prepare_prompt(self, this_message: dict, with_history: bool = True) -> Prompt:
+        await self._load_history()
+        await self._aware_overflow()
+
+        return self.prompt_builder.build(self._get_system_message(), self.messages if with_history else None,
+                                         (this_message,))
+
     async def request_llm(self, message: str, author=NOT_GIVEN, save_to_history=True,
                           response_type: Literal['text', 'json_object'] = 'text',
                           additional_content: dict = None, with_history: bool = True,
@@ -249,31 +554,24 @@ class OpenAIExecutor:
         """
         user_message = message
         self.reset_if_usercall(user_message)
+        self.turn_tool_results = {}
 
-        this_message = dict(content=f"{user_message}", role=OpenAIRoles.user.value)
-
-        if additional_content:
-            this_message = {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_message},
-                    additional_content
-                ]
-            }
-
-        await self._aware_overflow()
-
-        if with_history:
-            messages_to_use = list(self.messages)
-        else:
-            messages_to_use = []
-
-        prompt = [self.get_cur_system_message()] + messages_to_use + [this_message]
+        this_message = self._make_user_message(user_message, additional_content)
+        prompt = await self._prepare_prompt(this_message, with_history=with_history)
 
         # logging.debug(f"sending {prompt}")
 
-        choice, usage = await self._run_for_messages(full_prompt=prompt, author=author, response_type=response_type,
-                                                     model=custom_model)
+        choice, usage = None, None
+        use_cascade = self._use_cascade(custom_model, response_type)
+        if use_cascade:
+            choice, usage = await self._try_small_model(prompt, user_message, additional_content)
+
+        if choice is None:
+            spent_usage = usage
+            choice, usage = await self._run_for_messages(full_prompt=prompt, author=author,
+                                                         response_type=response_type, model=custom_model)
+            if use_cascade:
+                usage = self._record_main_route(spent_usage, usage)
         response_message: ChatCompletionMessage = choice.message
 
         if ai_tools.is_function_call(choice=choice):
@@ -288,15 +586,249 @@ class OpenAIExecutor:
 
         return response_message.content
 
+    async def request_llm_stream(self, message: str, author=NOT_GIVEN, save_to_history=True,
+                                 additional_content: dict = None, with_history: bool = True,
+                                 custom_model: str = None, call_session_id: str = None) -> AsyncIterator[str]:
+        """
+        Same as request_llm, but yields the response text piece by piece as soon as the model produces it.
+        If the model decides to call tools, they are processed as usual and the final answer is yielded at once.
+
+        :param message: received message
+        :param author: outer chat message author
+        :param save_to_history: if to save
+        :param additional_content: for example type: image_url
+        :param with_history: if to send the dialogue history
+        :param custom_model: is to use model not equal to default executor ones. Can break the tools!
+        :param call_session_id: current user call session id
+        :return: async iterator of text deltas
+        """
+        user_message = message
+        self.reset_if_usercall(user_message)
+        self.turn_tool_results = {}
+
+        this_message = self._make_user_message(user_message, additional_content)
+        prompt = await self._prepare_prompt(this_message, with_history=with_history)
+
+        choice, usage = None, None
+        use_cascade = self._use_cascade(custom_model)
+        if use_cascade:
+            # the small model answers fast enough to be sent at once
+            choice, usage = await self._try_small_model(prompt, user_message, additional_content)
+            if choice is not None and choice.message.content:
+                yield choice.message.content
+
+        if choice is None:
+            spent_usage = usage
+            async for item in self._stream_for_messages(full_prompt=prompt, model=custom_model):
+                if isinstance(item, tuple):
+                    choice, usage = item
+                else:
+                    yield item
+            if use_cascade:
+                usage = self._record_main_route(spent_usage, usage)
+
+        if ai_tools.is_function_call(choice=choice):
+            if choice.message.content:
+                # separating the preliminary comment from the final answer
+                yield "\n\n"
+            yield await self.process_tool_calls(choice, user_message, call_session_id=call_session_id,
+                                                save_to_history=save_to_history)
+            return
+
+        if save_to_history:
+            self.save_to_history(this_message, usage_dict=usage, author=author)
+            self.save_to_history(dict(role=OpenAIRoles.assistant.value, content=choice.message.content),
+                                 usage_dict=usage,
+                                 author=author)
+
+    def _use_cascade(self, custom_model: str = None, response_type: str = 'text') -> bool:
+        return bool(self.full_config.cascade_model) and not custom_model and response_type == 'text'
+
+    async def _route_turn(self, message: str, additional_content: dict = None) -> Route:
+        recent_messages = [self.messages[i] for i in range(max(0, len(self.messages) - 3), len(self.messages))]
+        route = route_turn(message, recent_messages, simple_words=self.full_config.cascade_simple_words,
+                           max_words=self.full_config.cascade_max_words, additional_content=additional_content)
+        if route is not None:
+            return route
+        if self.full_config.cascade_classifier:
+            return await self._classify_turn(message)
+        # the small model can give up itself
+        return 'small'
+
+    async def _classify_turn(self, message: str) -> Route:
+        completion_dict = dict(
+            model=self.full_config.cascade_model,
+            messages=[dict(role=OpenAIRoles.system.value, content=CLASSIFIER_REQUEST),
+                      dict(role=OpenAIRoles.user.value, content=f"{message}")],
+            max_tokens=3,
+            temperature=0,
+            extra_headers=self.default_headers
+        )
+        if self.extra_body:
+            completion_dict['extra_body'] = self.extra_body
+        try:
+            completion: ChatCompletion = await self._create_completion(completion_dict)
+        except Exception as e:
+            logging.warning(f"failed to classify the turn, using the main model: {e}")
+            return 'main'
+        CASCADE_STATS.record('classifier', self.process_usage(completion.usage))
+        answer = completion.choices[0].message.content or ""
+        return 'main' if 'COMPLEX' in answer.upper() else 'small'
+
+    async def _try_small_model(self, full_prompt: Prompt, message: str,
+                               additional_content: dict = None) -> tuple[Choice | None, dict | None]:
+        """
+        Gives the turn to the cascade small model if it looks simple.
+        Tool calls it decides on are processed by the main model.
+
+        :return: the small model choice and usage or None and the usage spent if the main model is needed
+        """
+        if await self._route_turn(message, additional_content) == 'main':
+            return None, None
+
+        if full_prompt.has_system:
+            small_prompt = self.prompt_builder.replace_system(full_prompt, dict(
+                role=OpenAIRoles.system.value, content=f"{full_prompt[0]['content']}\n\n{CASCADE_INSTRUCTION}"))
+        else:
+            small_prompt = full_prompt
+        choice, usage = await self._run_for_messages(full_prompt=small_prompt, model=self.full_config.cascade_model)
+        if is_escalation(choice):
+            CASCADE_STATS.record('escalated', usage)
+            return None, usage
+
+        route = 'tools' if ai_tools.is_function_call(choice=choice) else 'small'
+        CASCADE_STATS.record(route, usage)
+        if usage is not None:
+            usage['route'] = route
+        return choice, usage
+
+    def _record_main_route(self, spent_usage: dict | None, usage: dict | None) -> dict | None:
+        CASCADE_STATS.record('main', usage)
+        usage = merge_usage(spent_usage, usage)
+        if usage is not None:
+            usage['route'] = 'main'
+        return usage
+
     def reset_if_usercall(self, message):
         if self.reset_call in message:
-            self._reset()
+            self._reset(clear_persistent_history=True)
 
     def get_cur_system_message(self):
         return self.about_me
 
+    def _get_system_message(self):
+        """
+        current system message with the summary of the compacted part of the conversation if any
+        """
+        return self.prompt_builder.system(self.get_cur_system_message(), self.history_summary)
+
     def save_to_history(self, this_message: dict, usage_dict: dict = None, author=NOT_GIVEN):
         self.messages.append(this_message)
+        self.last_active = time.monotonic()
+        if self.history_store is not None:
+            self.history_store.append(self.history_key, this_message)
+        self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        """
+        Starts folding the oldest turns into the summary in background if the history is too big.
+        """
+        config = self.full_config
+        if not config.summary_model or not config.summary_threshold_tokens:
+            return
+        if self.messages.total_tokens <= config.summary_threshold_tokens:
+            return
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+
+        # folding the oldest half, ending right before a user message not to break the turns
+        to_fold = []
+        folded_tokens = 0
+        for index, message in enumerate(self.messages):
+            if folded_tokens >= self.messages.total_tokens // 2 and message['role'] == OpenAIRoles.user.value:
+                break
+            to_fold.append(message)
+            folded_tokens += self.messages.token_count(index)
+        if len(to_fold) == len(self.messages):
+            return
+        fold_until = self.messages.first_position + len(to_fold)
+        self._compaction_task = asyncio.create_task(self._compact(to_fold, fold_until))
+
+    async def _compact(self, to_fold: list, fold_until: int):
+        history = self.messages
+        transcript = "\n".join(f"{message['role']}: {text}" for message in to_fold
+                               if (text := _text_content(message)))
+        if self.history_summary:
+            transcript = f"[Previous summary]\n{self.history_summary}\n\n[Conversation]\n{transcript}"
+        summary_request = self.full_config.summarize_request or _DEFAULT_SUMMARY_REQUEST
+        try:
+            completion: ChatCompletion = await self._create_completion(dict(
+                model=self.full_config.summary_model,
+                messages=[dict(role=OpenAIRoles.system.value, content=summary_request),
+                          dict(role=OpenAIRoles.user.value, content=transcript)],
+                max_tokens=self.full_config.max_tokens,
+                extra_headers=self.default_headers), priority=Priority.background)
+            summary = completion.choices[0].message.content
+        except Exception as e:
+            logging.error(f"failed to summarize the history of {self.history_key}: {e}")
+            return
+        if not summary:
+            return
+
+        # no awaits below: the swap is atomic for the event loop.
+        if self.messages is not history:
+            # the history was reset or reloaded meanwhile
+            return
+        # some of the folded messages could have been evicted already
+        while self.messages and self.messages.first_position < fold_until:
+            self.messages.popleft()
+        self.history_summary = summary.strip()
+        if self.history_store is not None:
+            self.history_store.set_summary(self.history_key, self.history_summary, kept=len(self.messages))
+        logging.debug(f"{len(to_fold)} messages of {self.history_key} were folded into the summary")
+
+    async def _load_history(self):
+        """
+        Loads the persisted conversation on the first access
+        """
+        if self._history_loaded or self.history_store is None:
+            return
+        self._history_loaded = True
+        try:
+            stored_messages, summary = await self.history_store.load_conversation(self.history_key,
+                                                                                  limit=self.max_messages)
+        except Exception as e:
+            logging.error(f"failed to load the history for {self.history_key}: {e}")
+            return
+        if summary and not self.history_summary:
+            self.history_summary = summary
+        # messages could have been added while loading
+        self.messages = MessageHistory(stored_messages + list(self.messages), maxlen=self.max_messages)
+
+    def export_state(self) -> dict:
+        """
+        Dialogue state which is enough to restore this executor later with import_state.
+        :return: json serializable dict
+        """
+        return {
+            "messages": list(self.messages),
+            "max_messages": self.max_messages,
+            "config_max_messages": self.full_config.max_messages,
+            "config_max_tokens": self.full_config.max_tokens,
+            "history_summary": self.history_summary
+        }
+
+    def import_state(self, state: dict):
+        """
+        Restores the dialogue state exported with export_state.
+        :param state: export_state() result
+        """
+        self.max_messages = state.get("max_messages", self.max_messages)
+        self.full_config.max_messages = state.get("config_max_messages", self.full_config.max_messages)
+        self.full_config.max_tokens = state.get("config_max_tokens", self.full_config.max_tokens)
+        self.messages = MessageHistory(state.get("messages", []), maxlen=self.max_messages)
+        self.history_summary = state.get("history_summary")
+        self._history_loaded = True
 
     def _reset(self, clear_persistent_history=False):
         """
@@ -306,7 +838,14 @@ class OpenAIExecutor:
         """
         # never gets full, +1 for system
 
-        self.messages = deque(maxlen=self.max_messages)
+        self.messages = MessageHistory(maxlen=self.max_messages)
+        self.history_summary = None
+        self._compaction_task = None
+
+        if self.history_store is not None and clear_persistent_history:
+            self.history_store.clear(self.history_key)
+        # after a simple reset the persisted conversation is loaded again
+        self._history_loaded = self.history_store is None or clear_persistent_history
 
         try:
             wai = self.full_config.who_am_i.format(self.full_config.name)
@@ -335,27 +874,25 @@ class OpenAIExecutor:
             # raise BrokenPipeError("RECURSION ALERT: Too much tool calls. Stop the boat!")
             return "Looks like I work too much on my own. I need more time to think, can I continue?"
 
-        # using or not using previous dialogue in a tool call
-        if self.full_config.tools_with_history:
-            prompt = list(self.messages)
-            # if previous tool call messages are not in prompt
-            if not save_to_history and recursive_results:
-                prompt = prompt + recursive_results
-        else:
-            prompt = []
-
         message_dict = None
 
         if original_request_text:
             # if is None it's a tool call
             message_dict = dict(content=f"{original_request_text}", role=OpenAIRoles.user.value)
-            prompt.append(message_dict)
 
+        summarizer = self._summarize_tool_result if self.full_config.tool_result_summary_model else None
         tool_call_messages = await run_tool_calls(choice=choice, available_tools=self.tools, unique_id=self.unique_id,
-                                                  call_session_id=call_session_id)
+                                                  call_session_id=call_session_id,
+                                                  full_results=self.turn_tool_results, summarizer=summarizer,
+                                                  registry=self.tool_registry)
 
-        choice, usage = await self._run_for_messages(
-            full_prompt=[self.get_cur_system_message()] + prompt + tool_call_messages)
+        # using or not using previous dialogue in a tool call
+        history = self.messages if self.full_config.tools_with_history else None
+        # if previous tool call messages are not in the history
+        previous_results = recursive_results if history is not None and not save_to_history else ()
+        full_prompt = self.prompt_builder.build(self._get_system_message(), history, previous_results,
+                                                (message_dict,) if message_dict else (), tool_call_messages)
+        choice, usage = await self._run_for_messages(full_prompt=full_prompt)
         response_message: ChatCompletionMessage = choice.message
 
         if message_dict and save_to_history:
@@ -382,11 +919,48 @@ class OpenAIExecutor:
         else:
             return f"I did everything, but with no concrete result unfortunately"
 
+    async def _summarize_tool_result(self, tool_name: str, text: str, max_tokens: int) -> str:
+        completion_dict = dict(
+            model=self.full_config.tool_result_summary_model,
+            messages=[dict(role=OpenAIRoles.system.value,
+                           content=f"Condense the result of the '{tool_name}' tool. Keep every fact, number, name "
+                                   f"and id that can matter, drop the repetition and the markup. "
+                                   f"Stay under {max_tokens * 3 // 4} words."),
+                      dict(role=OpenAIRoles.user.value, content=text)],
+            max_tokens=max_tokens,
+            temperature=0,
+            extra_headers=self.default_headers
+        )
+        if self.extra_body:
+            completion_dict['extra_body'] = self.extra_body
+        completion: ChatCompletion = await self._create_completion(completion_dict)
+        return completion.choices[0].message.content
+
     async def _aware_overflow(self):
         """
         Checking if additional actions like cutting the message stack needed and doing it if needed.
+        Token and word counts are cached per message, so each message costs nothing after it was added.
+
+        With prompt_cache on, the history is cut in big chunks not to shift the cached prompt prefix every turn.
         """
-        words_check = check_word_overflow(list(self.messages), self.full_config.max_words_before_summary)
-        if words_check or len(self.messages) > self.max_messages:
-            self.messages.popleft()
+        max_messages = self.max_messages
+        max_tokens = self.full_config.max_history_tokens
+        max_words = self.full_config.max_words_before_summary
+
+        if self.full_config.prompt_cache:
+            # the turn to come adds at least 2 messages, evicting one by one if not cut now
+            if not self._history_overflows(max_messages - 2, max_tokens, max_words):
+                return
+            max_messages, max_tokens, max_words = (int(limit * PROMPT_CACHE_TRIM_RATIO) for limit in
+                                                   (max_messages, max_tokens, max_words))
+
+        while self.messages and self._history_overflows(max_messages, max_tokens, max_words):
             self.messages.popleft()
+            # the dialogue can not start with assistant or tool messages, they would be skipped anyway
+            while self.messages and self.messages.role(0) != OpenAIRoles.user.value:
+                self.messages.popleft()
+
+    def _history_overflows(self, max_messages: int, max_tokens: int, max_words: int) -> bool:
+        return (len(self.messages) > max_messages
+                or (max_tokens and self.messages.total_tokens > max_tokens)
+                or (max_words and self.messages.total_words > max_words))
@@ -13,12 +13,8 @@ def get_tool_implementation(executor, tool_name):
     Returns:
         Tool handler function
     """
-    for tool in executor.tools:
-        if tool.get("name") == tool_name:
-            if not tool.get("callable", None):
-                return None
-            return tool["callable"]
-    return None
+    spec = executor.tool_registry.get(tool_name)
+    return spec.implementation if spec else None
 
 
 def calculate_max_messages(config):
@@ -154,20 +150,34 @@ def process_usage(usage: dict, executor):
     }
 
 
-def prepare_message_prompt(messages_to_check: list) -> list:
-    messages_list: list = messages_to_check.copy()
+def add_cache_usage(usage_dict: dict, usage) -> dict:
+    """
+    Adds provider prompt cache statistics to the usage dict.
 
-    def is_bad_first_message() -> bool:
-        if not len(messages_list):
-            return False
-        first_message = messages_list[0]
-        return first_message['role'] != 'user'
+    Args:
+        usage_dict: usage dict to update
+        usage: CompletionUsage from the API response
 
-    while is_bad_first_message():
-        logging.debug("removing bad first message")
-        messages_list.pop(0)
+    Returns:
+        dict: usage dict with cached_tokens and cache_hit_ratio
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    prompt_tokens = usage_dict.get("prompt_tokens") or 0
+    usage_dict["cached_tokens"] = cached_tokens
+    usage_dict["cache_hit_ratio"] = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    return usage_dict
 
-    return messages_list
+
+def prepare_message_prompt(messages_to_check: list) -> list:
+    """
+    Drops the leading messages until the first user one: the conversation can not start with a tool result etc.
+    """
+    first_user = next((i for i, message in enumerate(messages_to_check) if message['role'] == 'user'),
+                      len(messages_to_check))
+    if first_user:
+        logging.debug(f"removing {first_user} bad first messages")
+    return messages_to_check[first_user:]
 
 
 def should_react(executor, message_content):
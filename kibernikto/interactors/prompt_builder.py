@@ -0,0 +1,72 @@
+from typing import Iterable
+
+from .message_history import MessageHistory
+
+
+class Prompt(list):
+    """
+    Request messages already checked by the PromptBuilder: the conversation starts with a user message.
+    """
+    has_system = False
+
+
+class PromptBuilder:
+    """
+    Assembles the request messages in one pass: system message, history and the turn messages.
+    The history is not copied or checked on the way, it keeps its valid start itself.
+    The system message with the conversation summary is built once and reused while they stay the same.
+    """
+
+    def __init__(self):
+        self._system_parts: tuple | None = None
+        self._system_message: dict | None = None
+
+    def system(self, base: dict, summary: str | None) -> dict:
+        """
+        :param base: configured system message
+        :param summary: summary of the compacted part of the conversation
+        :return: the system message to send
+        """
+        if not summary:
+            return base
+        if self._system_parts != (base['content'], summary):
+            self._system_parts = (base['content'], summary)
+            self._system_message = dict(role=base['role'],
+                                        content=f"{base['content']}\n\n[Earlier conversation summary]\n{summary}")
+        return self._system_message
+
+    @staticmethod
+    def build(system_message: dict | None, history: MessageHistory | None, *turn_parts: Iterable[dict]) -> Prompt:
+        """
+        :param system_message: system message or None
+        :param history: dialogue history to include or None
+        :param turn_parts: messages going after the history: user message, tool calls and results
+        :return: the prompt
+        """
+        prompt = Prompt()
+        if system_message:
+            prompt.append(system_message)
+            prompt.has_system = True
+        start = len(prompt)
+        if history is not None:
+            prompt.extend(history.from_first_user())
+        for part in turn_parts:
+            prompt.extend(part)
+        if len(prompt) > start and prompt[start]['role'] != 'user':
+            # no history to lead: the turn messages have to start with the user
+            first_user = next((i for i in range(start, len(prompt)) if prompt[i]['role'] == 'user'), len(prompt))
+            del prompt[start:first_user]
+        return prompt
+
+    @staticmethod
+    def replace_system(prompt: Prompt, system_message: dict) -> Prompt:
+        """
+        :return: the same prompt with another system message
+        """
+        replaced = Prompt(prompt)
+        replaced.has_system = True
+        if prompt.has_system:
+            replaced[0] = system_message
+        else:
+            replaced.insert(0, system_message)
+        return replaced
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import re
+import time
+import weakref
+from typing import Dict, Tuple
+
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.utils.metrics import METRICS
+from kibernikto.utils.tokens import estimate_message_tokens
+
+logger = logging.getLogger("kibernikto.rate_limiter")
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)?")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0, None: 1.0}
+
+# the provider limits are per minute if we know nothing else
+_DEFAULT_WINDOW = 60.0
+
+# backoff for the connection and server errors, seconds
+_RETRY_DELAY = 0.5
+_RETRY_MAX_DELAY = 8.0
+
+
+def parse_reset(value: str | None) -> float | None:
+    """
+    Parses x-ratelimit-reset-* and retry-after header values: "20ms", "1.5s", "6m0s", "30".
+
+    :return: seconds or None if the value can not be parsed
+    """
+    if not value:
+        return None
+    value = value.strip()
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(number + (unit or "") for number, unit in parts) != value:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit or None] for number, unit in parts)
+
+
+def estimate_request_tokens(completion_dict: dict) -> int:
+    """
+    Estimates the tokens the provider will count against the quota for the request: prompt and max output.
+    """
+    prompt_tokens = sum(estimate_message_tokens(message) for message in completion_dict.get('messages', []))
+    max_output = completion_dict.get('max_tokens') or completion_dict.get('max_completion_tokens') or 0
+    if not isinstance(max_output, int):
+        max_output = 0
+    return prompt_tokens + max_output
+
+
+class _Bucket:
+    """
+    Token bucket for one quota (requests or tokens) with the capacity and refill rate learned from the provider.
+    Unknown until the first response with rate limit headers, does not limit anything until then.
+    """
+
+    def __init__(self):
+        self.limit: float | None = None
+        self.level = 0.0
+        self.rate = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.limit is not None:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float, now: float) -> float:
+        if self.limit is None or self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        cost = min(cost, self.limit)
+        if self.level >= cost:
+            return 0.0
+        return (cost - self.level) / self.rate
+
+    def take(self, cost: float, now: float):
+        if self.limit is None:
+            return
+        self._refill(now)
+        self.level -= min(cost, self.limit)
+
+    def learn(self, limit: float, remaining: float, reset_seconds: float | None, headroom: float, now: float):
+        """
+        :param limit: full quota
+        :param remaining: quota left by the provider accounting
+        :param reset_seconds: time until the quota is full again
+        :param headroom: part of the quota we never use
+        """
+        reserve = limit * headroom
+        if reset_seconds and remaining < limit:
+            self.rate = (limit - remaining) / reset_seconds
+        elif not self.rate:
+            self.rate = limit / _DEFAULT_WINDOW
+        self._refill(now)
+        if self.limit is None:
+            self.level = remaining - reserve
+        else:
+            # our own calls sent after this response was made are already taken from the level
+            self.level = min(self.level, remaining - reserve)
+        self.limit = limit - reserve
+
+
+class _Quota:
+    def __init__(self):
+        self.requests = _Bucket()
+        self.tokens = _Bucket()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+        self.waited = 0
+        self.wait_time_total = 0.0
+        self.throttled = 0
+
+
+class RateLimiter:
+    """
+    Paces the calls to stay under the provider requests and tokens per minute limits
+    instead of hitting them and retrying.
+    Learns the limits from x-ratelimit-* response headers per (endpoint, model).
+    Retries the paced calls itself: the client retries would send them past the quota.
+    """
+
+    def __init__(self, enabled: bool = AI_SETTINGS.OPENAI_RATE_LIMITER,
+                 headroom: float = AI_SETTINGS.OPENAI_RATE_LIMIT_HEADROOM):
+        """
+        :param enabled: if False the calls are just passed through
+        :param headroom: part of the quota to keep unused for other clients of the same key
+        """
+        self.enabled = enabled
+        self.headroom = headroom
+        self._quotas: Dict[Tuple[str, str], _Quota] = {}
+        # client -> its copy without own retries
+        self._paced_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def _get_quota(self, endpoint: str, model: str) -> _Quota:
+        quota_key = (f"{endpoint}", f"{model}")
+        quota = self._quotas.get(quota_key)
+        if quota is None:
+            quota = _Quota()
+            self._quotas[quota_key] = quota
+        return quota
+
+    async def acquire(self, endpoint: str, model: str, tokens: int = 0):
+        """
+        Waits until the request with the given tokens cost fits the quota and takes it.
+        """
+        quota = self._get_quota(endpoint, model)
+        async with quota.lock:
+            now = time.monotonic()
+            delay = max(quota.blocked_until - now, quota.requests.delay(1, now), quota.tokens.delay(tokens, now))
+            if delay > 0:
+                logger.debug(f"{model} at {endpoint}: waiting {delay:.2f}s for the rate limit")
+                quota.waited += 1
+                quota.wait_time_total += delay
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+            quota.requests.take(1, now)
+            quota.tokens.take(tokens, now)
+
+    def learn(self, endpoint: str, model: str, headers):
+        """
+        Updates the quota from the response headers.
+        """
+        quota = self._get_quota(endpoint, model)
+        now = time.monotonic()
+        for bucket, kind in ((quota.requests, 'requests'), (quota.tokens, 'tokens')):
+            try:
+                limit = float(headers.get(f'x-ratelimit-limit-{kind}'))
+                remaining = float(headers.get(f'x-ratelimit-remaining-{kind}'))
+            except (TypeError, ValueError):
+                continue
+            if limit <= 0:
+                continue
+            bucket.learn(limit, remaining, parse_reset(headers.get(f'x-ratelimit-reset-{kind}')), self.headroom, now)
+
+    def block(self, endpoint: str, model: str, headers=None):
+        """
+        Stops all the calls to the model after 429 for the retry-after time.
+        """
+        quota = self._get_quota(endpoint, model)
+        quota.throttled += 1
+        retry_after = None
+        if headers is not None:
+            if headers.get('retry-after-ms'):
+                retry_after = parse_reset(f"{headers.get('retry-after-ms')}ms")
+            else:
+                retry_after = parse_reset(headers.get('retry-after'))
+        if retry_after is None:
+            retry_after = 1.0
+        quota.blocked_until = max(quota.blocked_until, time.monotonic() + retry_after)
+        logger.warning(f"{model} at {endpoint} is rate limited, pausing for {retry_after:.2f}s")
+
+    async def create(self, client: AsyncOpenAI, endpoint: str, completion_dict: dict):
+        """
+        Calls client.chat.completions.create within the quota.
+
+        :param client: client to call
+        :param endpoint: client base url, the quota is per endpoint and model
+        :param completion_dict: create() arguments
+        :return: ChatCompletion or AsyncStream if stream is set
+        """
+        if not self.enabled:
+            return await client.chat.completions.create(**completion_dict)
+        model = completion_dict['model']
+        tokens = estimate_request_tokens(completion_dict)
+        paced_client = self._paced_client(client)
+        attempt = 0
+        while True:
+            await self.acquire(endpoint, model, tokens)
+            try:
+                response = await paced_client.chat.completions.with_raw_response.create(**completion_dict)
+                break
+            except RateLimitError as e:
+                # the next acquire waits for the retry-after time
+                self.block(endpoint, model, e.response.headers)
+                if attempt >= client.max_retries:
+                    raise
+            except (APIConnectionError, InternalServerError) as e:
+                if attempt >= client.max_retries:
+                    raise
+                delay = min(_RETRY_DELAY * 2 ** attempt, _RETRY_MAX_DELAY)
+                logger.warning(f"{model} at {endpoint} failed: {e}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            attempt += 1
+        self.learn(endpoint, model, response.headers)
+        return response.parse()
+
+    def _paced_client(self, client: AsyncOpenAI) -> AsyncOpenAI:
+        """
+        :return: the client copy without retries, sharing the connection pool
+        """
+        paced_client = self._paced_clients.get(client)
+        if paced_client is None:
+            paced_client = self._paced_clients[client] = client.with_options(max_retries=0)
+        return paced_client
+
+    def stats(self) -> dict:
+        """
+        :return: learned limits and throttling counters per endpoint and model
+        """
+        return {f"{endpoint} {model}": {
+            "requests_limit": quota.requests.limit,
+            "requests_rate": quota.requests.rate,
+            "tokens_limit": quota.tokens.limit,
+            "tokens_rate": quota.tokens.rate,
+            "waited": quota.waited,
+            "wait_time_total": quota.wait_time_total,
+            "throttled": quota.throttled
+        } for (endpoint, model), quota in self._quotas.items()}
+
+
+RATE_LIMITER = RateLimiter()
+METRICS.register_stats("kibernikto_rate_limiter", RATE_LIMITER.stats, label="lane")
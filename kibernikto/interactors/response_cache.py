@@ -0,0 +1,35 @@
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.utils.cache import TTLCache, make_key, SingleFlight
+from kibernikto.utils.metrics import METRICS
+
+# shared by all the executors and plugins: identical stateless requests come from different chats
+RESPONSE_CACHE = TTLCache(max_entries=AI_SETTINGS.OPENAI_RESPONSE_CACHE_SIZE,
+                          ttl=AI_SETTINGS.OPENAI_RESPONSE_CACHE_TTL)
+# identical requests in flight at the same time are sent once
+REQUEST_FLIGHTS = SingleFlight()
+
+
+def completion_cache_key(base_url, completion_dict: dict) -> str:
+    """
+    Response cache key for the chat.completions.create params.
+    Only the params affecting the answer are used.
+
+    :param base_url: API url, different providers answer differently
+    :param completion_dict: chat.completions.create kwargs
+    :return: hash string
+    """
+    return make_key(str(base_url),
+                    completion_dict.get('model'),
+                    completion_dict.get('messages'),
+                    completion_dict.get('temperature'),
+                    completion_dict.get('response_format'),
+                    completion_dict.get('max_tokens') or completion_dict.get('max_completion_tokens'))
+
+
+def response_cache_stats() -> dict:
+    stats = RESPONSE_CACHE.stats()
+    stats["coalesced"] = REQUEST_FLIGHTS.coalesced
+    return stats
+
+
+METRICS.register_stats("kibernikto_response_cache", response_cache_stats)
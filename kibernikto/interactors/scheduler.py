@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Dict, Tuple
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.utils.metrics import METRICS
+
+logger = logging.getLogger("kibernikto.scheduler")
+
+
+class Priority(IntEnum):
+    """
+    LLM calls priority classes, lower goes first.
+    """
+    privileged = 0
+    private = 1
+    group = 2
+    background = 3
+
+
+# priority of the calls made by the current turn, the executor default if not set
+_TURN_PRIORITY: ContextVar[Priority | None] = ContextVar("kibernikto_turn_priority", default=None)
+
+
+@contextmanager
+def turn_priority(priority: Priority):
+    """
+    Sets the priority of all the LLM calls made within the block, tasks started in it included.
+    Per turn, so the concurrent turns of one executor do not change each other's priority.
+    """
+    token = _TURN_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _TURN_PRIORITY.reset(token)
+
+
+def current_turn_priority() -> Priority | None:
+    return _TURN_PRIORITY.get()
+
+
+class _Lane:
+    """
+    Calls queue for one (endpoint, model) pair.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        # (priority, virtual finish time, sequence, future)
+        self.waiters: list[tuple] = []
+        self.waiting = 0
+        # weighted fair queueing: virtual time of each chat and of the lane
+        self.virtual_clock = 0.0
+        self.chat_clocks: Dict[str, float] = {}
+        self.granted = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+
+class LLMScheduler:
+    """
+    Admission control for all the LLM calls of the process.
+    Limits concurrent calls per endpoint and model, lets higher priorities go first
+    and shares the capacity fairly between the chats of the same priority.
+    """
+
+    def __init__(self, max_concurrency: int = AI_SETTINGS.OPENAI_MAX_CONCURRENCY,
+                 model_concurrency: Dict[str, int] = None):
+        """
+        :param max_concurrency: max concurrent calls per (endpoint, model), 0 for no limit
+        :param model_concurrency: limits for concrete models
+        """
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = model_concurrency if model_concurrency is not None else dict(
+            AI_SETTINGS.OPENAI_MODEL_CONCURRENCY)
+        self._lanes: Dict[Tuple[str, str], _Lane] = {}
+        self._sequence = itertools.count()
+
+    def _get_lane(self, endpoint: str, model: str) -> _Lane:
+        lane_key = (f"{endpoint}", f"{model}")
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            lane = _Lane(limit=self.model_concurrency.get(model, self.max_concurrency))
+            self._lanes[lane_key] = lane
+        return lane
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str, model: str, priority: Priority = Priority.private, chat_key: str = None,
+                   weight: float = 1.0):
+        """
+        Waits until the call is allowed to go.
+
+        :param endpoint: API url
+        :param model: model name
+        :param priority: call priority class
+        :param chat_key: chat the call is made for, for the fair share
+        :param weight: chat share weight, chats with bigger weight get more calls
+        """
+        lane = self._get_lane(endpoint, model)
+        await self._acquire(lane, priority, chat_key, weight)
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    async def _acquire(self, lane: _Lane, priority: Priority, chat_key: str, weight: float):
+        start = time.monotonic()
+        if not lane.limit or (lane.active < lane.limit and not lane.waiting):
+            lane.active += 1
+            self._record_wait(lane, start)
+            return
+
+        chat_clock = max(lane.virtual_clock, lane.chat_clocks.get(chat_key, 0.0))
+        finish = chat_clock + 1.0 / weight
+        lane.chat_clocks[chat_key] = finish
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiters, (int(priority), finish, next(self._sequence), future))
+        lane.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was given right before the cancellation
+                self._release(lane)
+            else:
+                future.cancel()
+                lane.waiting -= 1
+            raise
+        self._record_wait(lane, start)
+
+    def _release(self, lane: _Lane):
+        lane.active -= 1
+        while lane.waiters and lane.active < lane.limit:
+            _, finish, _, future = heapq.heappop(lane.waiters)
+            if future.done():
+                continue
+            lane.virtual_clock = max(lane.virtual_clock, finish)
+            lane.active += 1
+            lane.waiting -= 1
+            future.set_result(True)
+        if len(lane.chat_clocks) > 10000:
+            lane.chat_clocks = {chat: clock for chat, clock in lane.chat_clocks.items()
+                                if clock > lane.virtual_clock}
+
+    def _record_wait(self, lane: _Lane, start: float):
+        waited = time.monotonic() - start
+        lane.granted += 1
+        lane.wait_time_total += waited
+        lane.wait_time_max = max(lane.wait_time_max, waited)
+
+    def stats(self) -> dict:
+        """
+        :return: active calls, queue depth and wait times per endpoint and model
+        """
+        return {f"{endpoint} {model}": {
+            "limit": lane.limit,
+            "active": lane.active,
+            "queue_depth": lane.waiting,
+            "granted": lane.granted,
+            "wait_time_avg": lane.wait_time_total / lane.granted if lane.granted else 0.0,
+            "wait_time_max": lane.wait_time_max
+        } for (endpoint, model), lane in self._lanes.items()}
+
+
+LLM_SCHEDULER = LLMScheduler()
+METRICS.register_stats("kibernikto_llm_scheduler", LLM_SCHEDULER.stats, label="lane")
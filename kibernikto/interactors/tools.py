@@ -1,14 +1,54 @@
+import inspect
+import json
 import logging
+import weakref
 from inspect import getmembers, isfunction, ismodule
-from typing import Any, Callable
+from typing import Any, Callable, Literal
 
 from pydantic import BaseModel
 
+from kibernikto.utils.tool_pools import resolve_execution_mode
+
+
+class ToolCachePolicy(BaseModel):
+    """
+    Tool results caching. Only for pure lookups with no side effects, i.e. weather or exchange rates.
+    """
+    ttl: float = 300  # seconds
+    key_fields: list[str] | None = None  # arguments the result depends on, all of them if None
+    scope: Literal['global', 'chat'] = 'global'  # share the results between the chats or not
+    max_entries: int = 256
+
 
 class Toolbox(BaseModel):
     function_name: str
     definition: dict
     implementation: Callable
+    # max simultaneous runs of this tool across all the chats, None for no limit
+    max_concurrency: int | None = None
+    cache: ToolCachePolicy | None = None
+    # seconds to wait for the result, None for AI_SETTINGS.OPENAI_TOOLS_TIMEOUT, 0 for no limit
+    timeout: float | None = None
+    # where to run: event loop, thread pool for blocking code, process pool for CPU heavy code
+    # None to run coroutine functions in the loop and the rest in threads
+    execution: Literal['async', 'thread', 'process'] | None = None
+    # bigger results are compacted, None for AI_SETTINGS.OPENAI_TOOLS_MAX_RESULT_TOKENS, 0 for no limit
+    max_result_tokens: int | None = None
+    # identical calls in one model answer are run once
+    # None to do it only for the cached tools: calls with side effects may be repeated on purpose
+    deduplicate: bool | None = None
+
+    @property
+    def deduplicated(self) -> bool:
+        return self.cache is not None if self.deduplicate is None else self.deduplicate
+
+    @property
+    def registry_key(self) -> tuple:
+        """
+        Same for the equal copies of the toolbox: config copies of the executors share one ToolRegistry.
+        """
+        return self.function_name, id(self.implementation), self.model_dump_json(exclude={'implementation'})
+
 
 def get_tools_from_module(python_module, permitted_names=[]):
     tools = []
@@ -27,3 +67,153 @@ def get_tools_from_module(python_module, permitted_names=[]):
         except Exception as e:
             logging.warning(f"skipping '{tool_name}' in tools {python_module.__name__}: {e}")
     return tools
+
+
+# executor params given to the tools declaring them, the model never sees them
+INJECTABLE_PARAMS = ('key', 'call_session_id')
+
+_JSON_TYPES = {
+    'string': (str,),
+    'integer': (int,),
+    'number': (int, float),
+    'boolean': (bool,),
+    'array': (list, tuple),
+    'object': (dict,),
+    'null': (type(None),)
+}
+
+
+class ToolArgumentsError(ValueError):
+    """
+    The model called the tool with wrong arguments.
+    """
+
+    def __init__(self, tool_name: str, problems: list[str]):
+        super().__init__(f"invalid arguments for '{tool_name}': {'; '.join(problems)}")
+        self.tool_name = tool_name
+        self.problems = problems
+
+    def to_result(self) -> dict:
+        """
+        :return: tool result telling the model what to fix
+        """
+        return {"error": "INVALID_ARGUMENTS", "tool": self.tool_name, "problems": self.problems,
+                "hint": "fix the arguments and call the tool again"}
+
+
+class ToolSpec:
+    """
+    Everything needed to call the tool, computed once: injectable params and the arguments validator.
+    """
+    __slots__ = ('name', 'toolbox', 'implementation', 'execution', 'injectable', 'params', 'accepts_kwargs',
+                 'required', 'properties')
+
+    def __init__(self, name: str, implementation: Callable, toolbox: Toolbox = None, definition: dict = None):
+        self.name = name
+        self.toolbox = toolbox
+        self.implementation = implementation
+        self.execution = resolve_execution_mode(implementation, toolbox.execution if toolbox else None)
+        signature = inspect.signature(implementation)
+        self.accepts_kwargs = any(param.kind == inspect.Parameter.VAR_KEYWORD
+                                  for param in signature.parameters.values())
+        self.params = frozenset(param_name for param_name, param in signature.parameters.items()
+                                if param.kind not in (inspect.Parameter.VAR_KEYWORD,
+                                                      inspect.Parameter.VAR_POSITIONAL))
+        self.injectable = tuple(param for param in INJECTABLE_PARAMS if param in self.params)
+
+        parameters = ((definition or {}).get('function') or {}).get('parameters') or {}
+        self.properties: dict[str, dict] = parameters.get('properties') or {}
+        required = set(parameters.get('required') or ())
+        # params with no defaults are needed even if the definition forgot them
+        required.update(param_name for param_name, param in signature.parameters.items()
+                        if param.default is inspect.Parameter.empty and param_name not in self.injectable
+                        and param.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                                           inspect.Parameter.KEYWORD_ONLY))
+        self.required = frozenset(required)
+
+    def parse_arguments(self, arguments: str | None) -> dict:
+        """
+        Parses and validates the model arguments.
+
+        :param arguments: tool call arguments json
+        :return: arguments dict
+        :raises ToolArgumentsError: with all the problems found
+        """
+        if not arguments:
+            dict_args = {}
+        else:
+            try:
+                dict_args = json.loads(arguments)
+            except json.JSONDecodeError as e:
+                raise ToolArgumentsError(self.name, [f"arguments are not valid json: {e}"])
+        if not isinstance(dict_args, dict):
+            raise ToolArgumentsError(self.name, ["arguments must be a json object"])
+
+        problems = [f"'{name}' is required" for name in sorted(self.required) if name not in dict_args]
+        for name, value in dict_args.items():
+            if name in self.injectable or (name not in self.params and not self.accepts_kwargs):
+                problems.append(f"'{name}' is not a parameter of the tool")
+                continue
+            schema = self.properties.get(name)
+            if schema:
+                problem = _check_value(name, value, schema)
+                if problem:
+                    problems.append(problem)
+        if problems:
+            raise ToolArgumentsError(self.name, problems)
+        return dict_args
+
+
+def _check_value(name: str, value: Any, schema: dict) -> str | None:
+    json_types = schema.get('type')
+    if json_types:
+        if isinstance(json_types, str):
+            json_types = [json_types]
+        python_types = tuple(python_type for json_type in json_types for python_type in _JSON_TYPES.get(json_type, ()))
+        if python_types and (not isinstance(value, python_types) or (
+                isinstance(value, bool) and bool not in python_types)):
+            return f"'{name}' must be {' or '.join(json_types)}, got {type(value).__name__}"
+    if 'enum' in schema and value not in schema['enum']:
+        return f"'{name}' must be one of {schema['enum']}"
+    return None
+
+
+class ToolRegistry:
+    """
+    Tools set prepared for dispatching: O(1) lookup by name, ready definitions and names lists.
+    Shared by the executors having the same tools, see get_tool_registry.
+    """
+
+    def __init__(self, tools: list[Toolbox]):
+        self.tools = tuple(tools)
+        self.definitions: list[dict] = [toolbox.definition for toolbox in self.tools]
+        self.names: list[str] = [toolbox.function_name for toolbox in self.tools]
+        self._specs: dict[str, ToolSpec] = {}
+        for toolbox in self.tools:
+            spec = ToolSpec(toolbox.function_name, toolbox.implementation, toolbox=toolbox,
+                            definition=toolbox.definition)
+            self._specs.setdefault(toolbox.function_name, spec)
+            # the model calls the tool by the definition name
+            definition_name = (toolbox.definition.get('function') or {}).get('name')
+            if definition_name:
+                self._specs.setdefault(definition_name, spec)
+
+    def get(self, name: str) -> ToolSpec | None:
+        return self._specs.get(name)
+
+
+# registries live while some executor holds them
+_REGISTRIES: weakref.WeakValueDictionary[tuple, ToolRegistry] = weakref.WeakValueDictionary()
+
+
+def get_tool_registry(tools: list[Toolbox]) -> ToolRegistry:
+    """
+    :param tools: executor tools
+    :return: the registry for these tools or their copies, built if nobody holds it
+    """
+    registry_key = tuple(toolbox.registry_key for toolbox in tools)
+    registry = _REGISTRIES.get(registry_key)
+    if registry is None:
+        registry = ToolRegistry(tools)
+        _REGISTRIES[registry_key] = registry
+    return registry
@@ -42,7 +42,7 @@ class ImageSummaryPlugin(KiberniktoPlugin):
 
     async def run_for_message(self, message: str):
         try:
-            result = await self._run(message)
+            result = await self._run_coalesced(message, self._run)
             return result
         except PermissionDeniedError as pde:
             logging.error(f'PermissionDeniedError while getting image description from {message}: {pde}', )
@@ -76,10 +76,10 @@ class ImageSummaryPlugin(KiberniktoPlugin):
             ]
         }
 
-        completion: ChatCompletion = await self.client_async.chat.completions.create(model=self.model,
-                                                                                     messages=[message],
-                                                                                     max_tokens=DEFAULT_SETTINGS.OPENAI_MAX_TOKENS,
-                                                                                     temperature=DEFAULT_SETTINGS.OPENAI_TEMPERATURE)
+        completion: ChatCompletion = await self._create_completion(model=self.model,
+                                                                   messages=[message],
+                                                                   max_tokens=DEFAULT_SETTINGS.OPENAI_MAX_TOKENS,
+                                                                   temperature=DEFAULT_SETTINGS.OPENAI_TEMPERATURE)
         response_text = completion.choices[0].message.content.strip()
         logging.info(response_text)
         return response_text
@@ -1,5 +1,17 @@
 from abc import ABC, abstractmethod
-from openai import AsyncOpenAI
+from typing import Callable, Awaitable
+
+from openai.types.chat import ChatCompletion
+
+from kibernikto.bots.ai_settings import AI_SETTINGS
+from kibernikto.interactors.clients import get_client
+from kibernikto.interactors.response_cache import RESPONSE_CACHE, completion_cache_key
+from kibernikto.interactors.rate_limiter import RATE_LIMITER
+from kibernikto.interactors.scheduler import LLM_SCHEDULER
+from kibernikto.utils.cache import SingleFlight
+
+# the same link posted to several chats at once is processed once
+_PLUGIN_FLIGHTS = SingleFlight()
 
 
 class KiberniktoPluginException(Exception):
@@ -20,7 +32,7 @@ class KiberniktoPlugin(ABC):
 
     def __init__(self, model: str, base_url: str, api_key: str,
                  base_message: str, post_process_reply=False,
-                 store_reply=False):
+                 store_reply=False, cache_responses: bool = AI_SETTINGS.OPENAI_RESPONSE_CACHE):
         """
 
         :param model:
@@ -29,6 +41,7 @@ class KiberniktoPlugin(ABC):
         :param base_message:
         :param post_process_reply: if plugin reply should be used as input for further actions (i.e. other plugins or final ai message)
         :param store_reply: if the result should be stored in the messages storage at bot level
+        :param cache_responses: if to reuse the answers for identical requests
         """
         self.post_process_reply = post_process_reply
         self.store_reply = store_reply
@@ -36,7 +49,38 @@ class KiberniktoPlugin(ABC):
         self.model = model
         self.base_message = base_message
         self.base_url = base_url
-        self.client_async = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        self.client_async = get_client(base_url=base_url, api_key=api_key)
+        self.cache_responses = cache_responses
+
+    async def _create_completion(self, **completion_dict) -> ChatCompletion:
+        """
+        chat.completions.create with the optional response cache
+        """
+        if not self.cache_responses:
+            return await self._call_api(completion_dict)
+
+        cache_key = completion_cache_key(self.base_url, completion_dict)
+        completion = RESPONSE_CACHE.get(cache_key, None)
+        if completion is None:
+            completion = await self._call_api(completion_dict)
+            # cut answers are not worth repeating
+            if completion.choices and completion.choices[0].finish_reason != 'length':
+                RESPONSE_CACHE.set(cache_key, completion)
+        return completion
+
+    async def _call_api(self, completion_dict: dict) -> ChatCompletion:
+        async with LLM_SCHEDULER.slot(self.base_url, completion_dict['model']):
+            return await RATE_LIMITER.create(self.client_async, self.base_url, completion_dict)
+
+    async def _run_coalesced(self, message: str, run: Callable[[str], Awaitable[str]]) -> str:
+        """
+        Runs the plugin processing once for concurrent identical messages.
+        """
+        if not AI_SETTINGS.OPENAI_COALESCE_REQUESTS:
+            return await run(message)
+        flight_key = (self.__class__.__name__, self.model, self.base_url, self.client_async.api_key,
+                      self.base_message, message)
+        return await _PLUGIN_FLIGHTS.do(flight_key, lambda: run(message))
 
     @abstractmethod
     async def run_for_message(self, message: str) -> str:
@@ -52,7 +52,7 @@ class YoutubePlugin(KiberniktoPlugin):
 
     async def run_for_message(self, message: str):
         try:
-            result = await self._run(message)
+            result = await self._run_coalesced(message, self._run)
             return result
         except Exception as error:
             error_text = f'failed to get video transcript from {message}: {str(error)}'
@@ -84,11 +84,11 @@ class YoutubePlugin(KiberniktoPlugin):
             "content": f"{content_to_summarize} \n {additional_text}"
         }
 
-        completion: ChatCompletion = await self.client_async.chat.completions.create(model=self.model,
-                                                                                     messages=[message],
-                                                                                     max_tokens=DEFAULT_SETTINGS.OPENAI_MAX_TOKENS,
-                                                                                     temperature=0.8,
-                                                                                     )
+        completion: ChatCompletion = await self._create_completion(model=self.model,
+                                                                   messages=[message],
+                                                                   max_tokens=DEFAULT_SETTINGS.OPENAI_MAX_TOKENS,
+                                                                   temperature=0.8,
+                                                                   )
         response_text = completion.choices[0].message.content.strip()
         logging.info(response_text)
         return response_text
@@ -1 +1,2 @@
-from ._executor_corral import init, get_ai_executor, executor_exists, get_ai_executor_full, kill, get_temp_executor
+from ._executor_corral import init, get_ai_executor, executor_exists, get_ai_executor_full, kill, get_temp_executor, \
+    executor_turn, wake_executor, memory_stats
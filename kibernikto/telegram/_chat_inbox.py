@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, AsyncIterator
+
+from aiogram import types
+
+logger = logging.getLogger("kibernikto.inbox")
+
+
+class _ChatState:
+    def __init__(self):
+        self.pending: list[str] = []
+        self.collecting = False
+        self.last_arrival = 0.0
+        self.lock = asyncio.Lock()
+        # turns holding or waiting for the lock: a released lock is not taken by the next waiter at once
+        self.turns = 0
+
+
+class ChatInbox:
+    """
+    Per chat message queue: turns of one chat go one by one, messages sent in a burst become one turn.
+    Different chats do not wait for each other.
+    """
+
+    def __init__(self, debounce_seconds: float = 0.0, max_wait_seconds: float = 5.0):
+        """
+        :param debounce_seconds: how long to wait for the next message of a burst
+        :param max_wait_seconds: max time to collect a burst for
+        """
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self._chats: Dict[int | str, _ChatState] = {}
+
+    @asynccontextmanager
+    async def turn(self, chat_id: int | str, text: str, merge: bool = True) -> AsyncIterator[str | None]:
+        """
+        Waits for the chat turn and gives the text of all the messages collected for it.
+        Messages arriving while the turn is being collected or the previous turn is running are merged in.
+
+        :param chat_id: chat to queue the message in
+        :param text: processed message text
+        :param merge: if False, the message gets its own turn, still waiting for the previous ones
+        :return: merged text of the turn or None if the message was merged into another message turn
+        """
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = _ChatState()
+            self._chats[chat_id] = state
+
+        if not merge:
+            state.turns += 1
+            try:
+                async with state.lock:
+                    yield text
+            finally:
+                state.turns -= 1
+                self._forget_if_idle(chat_id, state)
+            return
+
+        now = time.monotonic()
+        state.pending.append(text)
+        state.last_arrival = now
+        if state.collecting:
+            yield None
+            return
+
+        state.collecting = True
+        state.turns += 1
+        try:
+            try:
+                deadline = now + self.max_wait_seconds
+                while self.debounce_seconds:
+                    wait = min(state.last_arrival + self.debounce_seconds, deadline) - time.monotonic()
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                await state.lock.acquire()
+            finally:
+                state.collecting = False
+
+            texts, state.pending = state.pending, []
+            if len(texts) > 1:
+                logger.debug(f"{len(texts)} messages of {chat_id} merged into one turn")
+            try:
+                yield "\n\n".join(texts)
+            finally:
+                state.lock.release()
+        finally:
+            state.turns -= 1
+            self._forget_if_idle(chat_id, state)
+
+    def _forget_if_idle(self, chat_id: int | str, state: _ChatState):
+        if not state.turns and not state.pending and not state.collecting and self._chats.get(chat_id) is state:
+            del self._chats[chat_id]
+
+    def queue_depth(self) -> int:
+        """
+        :return: number of messages waiting for their turn in all the chats
+        """
+        return sum(len(state.pending) for state in self._chats.values())
+
+
+def forward_label(message: types.Message) -> str:
+    """
+    Describes where the forwarded message comes from, empty string for usual messages.
+    """
+    origin = message.forward_origin
+    if origin is None:
+        return ""
+    if isinstance(origin, types.MessageOriginUser):
+        source = origin.sender_user.full_name
+    elif isinstance(origin, types.MessageOriginHiddenUser):
+        source = origin.sender_user_name
+    elif isinstance(origin, types.MessageOriginChannel):
+        source = origin.chat.title
+    elif isinstance(origin, types.MessageOriginChat):
+        source = origin.sender_chat.title
+    else:
+        source = "unknown"
+    return f"[forwarded from {source}]"
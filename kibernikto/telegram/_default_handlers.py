@@ -4,10 +4,14 @@ from aiogram import types, enums, F
 from aiogram.filters import or_f, and_f
 from aiogram.fsm.state import default_state
 
-from kibernikto.utils.ai_executor import get_ready_executor
+from kibernikto.interactors import turn_priority
+from kibernikto.utils.ai_executor import get_ready_executor, get_priority
 from kibernikto.utils.permissions import admin_or_public
 from . import dispatcher as cd
-from ..utils.telegram import reply
+from ._chat_inbox import forward_label
+from ._executor_corral import executor_turn
+from ._metrics import PREPROCESS_SECONDS
+from ..utils.telegram import reply, stream_reply
 
 
 @cd.dp.message(
@@ -19,19 +23,32 @@ async def private_message(message: types.Message):
         await message.reply(text=negative_reply_text)
         await message.forward(cd.TELEGRAM_SETTINGS.TG_MASTER_ID)
     else:
-        user_text = await cd.preprocessor.process_tg_message(message,
-                                                             tg_bot=cd.tg_bot)
+        with PREPROCESS_SECONDS.time(message.content_type.value):
+            user_text = await cd.preprocessor.process_tg_message(message,
+                                                                 tg_bot=cd.tg_bot)
         if user_text is None:
             return None  # do not reply
-        user_ai = await get_ready_executor(message=message)
+        if message.forward_origin:
+            user_text = f"{forward_label(message)} {user_text}"
 
-        await cd.tg_bot.send_chat_action(message.chat.id, 'typing')
-        reply_text = await user_ai.heed_and_reply(message=user_text)
+        # one turn at a time for a chat, bursts of messages are answered once
+        async with cd.inbox.turn(message.chat.id, user_text) as turn_text:
+            if turn_text is None:
+                return None  # merged into the turn of another message
+            with executor_turn(message.chat.id), turn_priority(get_priority(message)):
+                user_ai = await get_ready_executor(message=message)
 
-        if reply_text is None:
-            reply_text = "My iron brain did not generate anything!"
+                await cd.tg_bot.send_chat_action(message.chat.id, 'typing')
+                if cd.TELEGRAM_SETTINGS.TG_STREAM_REPLIES:
+                    await stream_reply(message=message, deltas=user_ai.heed_and_reply_stream(message=turn_text),
+                                       edit_interval=cd.TELEGRAM_SETTINGS.TG_STREAM_EDIT_INTERVAL)
+                    return None
+                reply_text = await user_ai.heed_and_reply(message=turn_text)
 
-        await reply(message=message, reply_text=reply_text)
+            if reply_text is None:
+                reply_text = "My iron brain did not generate anything!"
+
+            await reply(message=message, reply_text=reply_text)
 
 
 # noinspection SpellCheckingInspection
@@ -56,15 +73,21 @@ async def group_message(message: types.Message):
             await message.forward(chat_id=cd.TELEGRAM_SETTINGS.TG_MASTER_ID)
             return None
 
-        user_text = await cd.preprocessor.process_tg_message(message,
-                                                             tg_bot=cd.tg_bot)
+        with PREPROCESS_SECONDS.time(message.content_type.value):
+            user_text = await cd.preprocessor.process_tg_message(message,
+                                                                 tg_bot=cd.tg_bot)
         if user_text is None:
             return None  # do not reply
 
-        await cd.tg_bot.send_chat_action(chat_id, 'typing')
-        reply_text = await group_ai.heed_and_reply(message=user_text, author=message.from_user.username)
+        # different people talk in groups: no merging, just one turn at a time
+        async with cd.inbox.turn(chat_id, user_text, merge=False):
+            with executor_turn(chat_id), turn_priority(get_priority(message)):
+                # the executor could be evicted while the turn was waiting
+                group_ai = await get_ready_executor(message=message)
+                await cd.tg_bot.send_chat_action(chat_id, 'typing')
+                reply_text = await group_ai.heed_and_reply(message=user_text, author=message.from_user.username)
 
-        await reply(message=message, reply_text=reply_text)
+            await reply(message=message, reply_text=reply_text)
 
 
 def imported_ok():
@@ -1,15 +1,28 @@
+import asyncio
+import heapq
 import logging
 import sys
+import time
 import traceback
-from contextlib import asynccontextmanager
-from typing import Dict, Type
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from typing import Callable, Dict, Type
 
 from aiogram.types import User, Chat
 from pydantic import BaseModel
+from pydantic_settings import BaseSettings
 
-from kibernikto.interactors import OpenAiExecutorConfig
+from kibernikto.interactors import OpenAiExecutorConfig, close_clients, is_shared_client, close_history_store, \
+    close_batch_submitters
+from kibernikto.utils.memory import deep_size
+from kibernikto.utils.metrics import METRICS
+from kibernikto.utils.tool_pools import shutdown_tool_pools
 from kibernikto.telegram.telegram_bot import TelegramBot, KiberniktoChatInfo
 from kibernikto.bots.telegram_agent import KiberniktoTelegramAgent
+from . import _hibernation
+
+logger = logging.getLogger("kibernikto.corral")
 
 
 class AIBotConfig(BaseModel):
@@ -18,7 +31,32 @@ class AIBotConfig(BaseModel):
     username: str
 
 
-__BOTS: Dict[int | str, TelegramBot | KiberniktoTelegramAgent] = {}
+class CorralSettings(BaseSettings):
+    # 0 means no limit for all the limits below
+    TG_EXECUTORS_MAX_COUNT: int = 0
+    TG_EXECUTORS_IDLE_TTL: int = 0  # seconds
+    TG_EXECUTORS_MAX_MEMORY_MB: float = 0
+    TG_EXECUTORS_SWEEP_INTERVAL: int = 60  # seconds between idle and memory checks
+    TG_EXECUTORS_MIN_IDLE: int = 60  # executors used recently are never evicted
+    TG_HIBERNATION_ENABLED: bool = True
+    TG_HIBERNATION_LOCATION: str = "/tmp/kibernikto_hibernation"
+
+
+CORRAL_SETTINGS = CorralSettings()
+
+# least recently used first
+__BOTS: OrderedDict[int | str, TelegramBot | KiberniktoTelegramAgent] = OrderedDict()
+# turns running by key: busy executors are never evicted
+__BUSY: Dict[int | str, int] = {}
+__LAST_SWEEP: float = 0.0
+# config and chat_info bytes measured once on executor creation: they do not change afterwards
+__STATIC_SIZES: Dict[int | str, tuple[int, int]] = {}
+# bytes of the own (not shared) clients by id
+__CLIENT_SIZES: Dict[int, int] = {}
+# snapshots not on disk: being written in the background or loaded for waking up
+__HIBERNATING: Dict[int | str, dict] = {}
+# the last write by key: writes of one key go one by one
+__HIBERNATION_WRITES: Dict[int | str, asyncio.Task] = {}
 __BOT_CLASS: Type[TelegramBot | KiberniktoTelegramAgent] = None
 __EXECUTOR_CONFIG: AIBotConfig = None
 
@@ -43,12 +81,21 @@ def init(master_id: int, username: str, config: OpenAiExecutorConfig,
 async def kill(exact_ids=()):
     for key in __BOTS:
         bot = __BOTS[key]
+        if is_shared_client(bot.client):
+            continue
         if exact_ids:
             if key in exact_ids and bot.restrict_client_instance is not True:
                 await bot.client.close()
         else:
             # this will kill a global client. So it has to be restarted manually after this.
             await bot.client.close()
+    if not exact_ids:
+        await asyncio.gather(*__HIBERNATION_WRITES.values(), return_exceptions=True)
+        # shared clients are closed once for everyone
+        await close_batch_submitters()
+        await close_clients()
+        shutdown_tool_pools()
+        await close_history_store()
 
 
 def get_ai_executor(key_id: int | str) -> TelegramBot:
@@ -59,15 +106,52 @@ def get_ai_executor(key_id: int | str) -> TelegramBot:
 @asynccontextmanager
 async def get_temp_executor(key_id: int | str) -> TelegramBot:
     bot = _new_executor(key_id=key_id)
+    # temp dialogues are not persisted not to mix with the real chat having the same key
+    bot.history_store = None
     try:
         yield bot
     finally:
-        if bot and bot.restrict_client_instance is not True:
+        if bot and bot.restrict_client_instance is not True and not is_shared_client(bot.client):
             await bot.client.close()
 
 
 def executor_exists(key_id: int | str) -> bool:
-    return key_id in __BOTS
+    """
+    :return: True if the executor is in memory or hibernated
+    """
+    return key_id in __BOTS or key_id in __HIBERNATING or (
+            CORRAL_SETTINGS.TG_HIBERNATION_ENABLED and
+            _hibernation.exists(CORRAL_SETTINGS.TG_HIBERNATION_LOCATION, key_id))
+
+
+@contextmanager
+def executor_turn(key_id: int | str):
+    """
+    Marks the executor busy for the turn: it is not evicted until the turn ends,
+    so the messages the turn saves are not lost.
+    """
+    __BUSY[key_id] = __BUSY.get(key_id, 0) + 1
+    try:
+        yield
+    finally:
+        __BUSY[key_id] -= 1
+        if not __BUSY[key_id]:
+            del __BUSY[key_id]
+        bot = __BOTS.get(key_id)
+        if bot is not None:
+            bot.last_active = time.monotonic()
+
+
+async def wake_executor(key_id: int | str):
+    """
+    Loads the hibernated executor snapshot off the event loop, so get_ai_executor_full does not read the disk.
+    """
+    if (not CORRAL_SETTINGS.TG_HIBERNATION_ENABLED or key_id in __BOTS or key_id in __HIBERNATING or
+            not _hibernation.exists(CORRAL_SETTINGS.TG_HIBERNATION_LOCATION, key_id)):
+        return
+    snapshot = await asyncio.to_thread(_hibernation.load, CORRAL_SETTINGS.TG_HIBERNATION_LOCATION, key_id)
+    if snapshot and key_id not in __BOTS and key_id not in __HIBERNATING:
+        __HIBERNATING[key_id] = snapshot
 
 
 def get_ai_executor_full(chat: Chat, user: User = None, hide_errors=True) -> TelegramBot:
@@ -75,11 +159,191 @@ def get_ai_executor_full(chat: Chat, user: User = None, hide_errors=True) -> Tel
     bot = __BOTS.get(chat_key)
 
     if not bot:
-        chat_info = KiberniktoChatInfo(chat, user)
-        bot = _new_executor(key_id=chat_key, chat_info=chat_info)
+        bot = _rehydrate(chat_key)
+        if not bot:
+            chat_info = KiberniktoChatInfo(chat, user)
+            bot = _new_executor(key_id=chat_key, chat_info=chat_info)
         if hasattr(bot, 'hide_errors'):
             bot.hide_errors = hide_errors
         __BOTS[chat_key] = bot
+        __STATIC_SIZES[chat_key] = (deep_size(bot.full_config), deep_size(bot.chat_info))
+    else:
+        __BOTS.move_to_end(chat_key)
+    bot.last_active = time.monotonic()
+    _evict_if_needed()
+    return bot
+
+
+def _evict_if_needed():
+    """
+    Evicts least recently used executors exceeding the count limit.
+    Idle and memory limits are checked not more often than TG_EXECUTORS_SWEEP_INTERVAL.
+    """
+    global __LAST_SWEEP
+    now = time.monotonic()
+    min_idle = CORRAL_SETTINGS.TG_EXECUTORS_MIN_IDLE
+
+    max_count = CORRAL_SETTINGS.TG_EXECUTORS_MAX_COUNT
+    if max_count:
+        _evict_idle(lambda: len(__BOTS) > max_count, min_idle, now)
+
+    if now - __LAST_SWEEP < CORRAL_SETTINGS.TG_EXECUTORS_SWEEP_INTERVAL:
+        return
+    __LAST_SWEEP = now
+
+    idle_ttl = CORRAL_SETTINGS.TG_EXECUTORS_IDLE_TTL
+    if idle_ttl:
+        _evict_idle(lambda: True, max(idle_ttl, min_idle), now)
+
+    max_memory = CORRAL_SETTINGS.TG_EXECUTORS_MAX_MEMORY_MB * 1024 * 1024
+    if max_memory:
+        total = sum(_approx_history_size(bot) for bot in __BOTS.values())
+
+        def evicted(bot: TelegramBot):
+            nonlocal total
+            total -= _approx_history_size(bot)
+
+        _evict_idle(lambda: total > max_memory, min_idle, now, on_evict=evicted)
+
+
+def _evict_idle(needed: Callable[[], bool], min_idle: float, now: float,
+                on_evict: Callable[[TelegramBot], None] = None):
+    """
+    Evicts from the least recently used end while needed() and the executors are idle for min_idle.
+    Busy executors are moved to the recent end: they are in use.
+
+    :param on_evict: called with every evicted executor
+    """
+    skipped = 0
+    while __BOTS and skipped < len(__BOTS) and needed():
+        key = next(iter(__BOTS))
+        if key in __BUSY:
+            __BOTS.move_to_end(key)
+            skipped += 1
+            continue
+        bot = __BOTS[key]
+        if now - bot.last_active < min_idle:
+            return
+        _evict(key)
+        if on_evict is not None:
+            on_evict(bot)
+
+
+def _approx_history_size(bot: TelegramBot) -> int:
+    return bot.messages.memory_bytes
+
+
+def _client_size(bot: TelegramBot) -> int:
+    if is_shared_client(bot.client):
+        return 0
+    size = __CLIENT_SIZES.get(id(bot.client))
+    if size is None:
+        size = __CLIENT_SIZES[id(bot.client)] = deep_size(bot.client)
+    return size
+
+
+def memory_stats(top: int = 10) -> dict:
+    """
+    Approximate memory taken by the executors in the corral.
+    History sizes are kept up to date by the histories themselves, configs and chat infos are measured
+    once per executor and own clients once per client, so it is cheap to call every minute.
+    Shared clients are not counted.
+
+    :param top: how many heaviest chats to list
+    :return: executors counts, active ones used within TG_EXECUTORS_MIN_IDLE, total bytes by part and the top chats
+    """
+    now = time.monotonic()
+    active_window = CORRAL_SETTINGS.TG_EXECUTORS_MIN_IDLE
+    totals = dict(history=0, config=0, chat_info=0, client=0)
+    chats = []
+    active = 0
+    clients = {}
+    for key, bot in __BOTS.items():
+        config_size, chat_info_size = __STATIC_SIZES.get(key, (0, 0))
+        sizes = dict(history=_approx_history_size(bot), config=config_size, chat_info=chat_info_size,
+                     client=_client_size(bot))
+        clients[id(bot.client)] = sizes['client']
+        for part, size in sizes.items():
+            totals[part] += size
+        if key in __BUSY or now - bot.last_active < active_window:
+            active += 1
+        chats.append((sum(sizes.values()), key, sizes, len(bot.messages)))
+    # the clients of the evicted executors are gone
+    for client_id in [client_id for client_id in __CLIENT_SIZES if client_id not in clients]:
+        del __CLIENT_SIZES[client_id]
+    heaviest = heapq.nlargest(top, chats, key=lambda chat: chat[0])
+    return dict(executors=len(__BOTS), active=active, idle=len(__BOTS) - active,
+                total_bytes=sum(totals.values()), **{f"{part}_bytes": size for part, size in totals.items()},
+                top=[dict(key=key, total_bytes=total, messages=messages, **{f"{part}_bytes": size
+                                                                            for part, size in sizes.items()})
+                     for total, key, sizes, messages in heaviest])
+
+
+METRICS.register_stats("kibernikto_corral", lambda: memory_stats(top=0))
+
+
+def _evict(key_id: int | str):
+    bot = __BOTS.pop(key_id)
+    __STATIC_SIZES.pop(key_id, None)
+    if not CORRAL_SETTINGS.TG_HIBERNATION_ENABLED:
+        logger.info(f"executor {key_id} evicted")
+        return
+    snapshot = bot.export_state()
+    if bot.chat_info is not None:
+        snapshot['chat_info'] = bot.chat_info.to_dict()
+    __HIBERNATING[key_id] = snapshot
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        _save_snapshot(key_id, snapshot)
+        __HIBERNATING.pop(key_id, None)
+        return
+    task = asyncio.create_task(_hibernate(key_id, snapshot, __HIBERNATION_WRITES.get(key_id)))
+    __HIBERNATION_WRITES[key_id] = task
+    task.add_done_callback(partial(_write_done, key_id))
+
+
+def _write_done(key_id: int | str, task: asyncio.Task):
+    if __HIBERNATION_WRITES.get(key_id) is task:
+        del __HIBERNATION_WRITES[key_id]
+
+
+async def _hibernate(key_id: int | str, snapshot: dict, previous_write: asyncio.Task | None):
+    if previous_write is not None:
+        # an older snapshot of the same executor must not overwrite this one
+        await asyncio.gather(previous_write, return_exceptions=True)
+    location = CORRAL_SETTINGS.TG_HIBERNATION_LOCATION
+    if __HIBERNATING.get(key_id) is snapshot:
+        # serializing, compressing and writing stay off the event loop
+        await asyncio.to_thread(_save_snapshot, key_id, snapshot)
+        if __HIBERNATING.get(key_id) is snapshot:
+            __HIBERNATING.pop(key_id)
+            return
+    if key_id not in __HIBERNATING:
+        # woke up before or while being written: the file is stale
+        await asyncio.to_thread(_hibernation.remove_snapshot, location, key_id)
+
+
+def _save_snapshot(key_id: int | str, snapshot: dict):
+    try:
+        _hibernation.save(CORRAL_SETTINGS.TG_HIBERNATION_LOCATION, key_id, snapshot)
+        logger.info(f"executor {key_id} hibernated")
+    except Exception as e:
+        logger.error(f"failed to hibernate executor {key_id}: {e}")
+
+
+def _rehydrate(key_id: int | str) -> TelegramBot | None:
+    if not CORRAL_SETTINGS.TG_HIBERNATION_ENABLED:
+        return None
+    snapshot = __HIBERNATING.pop(key_id, None)
+    if snapshot is None:
+        snapshot = _hibernation.load(CORRAL_SETTINGS.TG_HIBERNATION_LOCATION, key_id)
+    if not snapshot:
+        return None
+    chat_info = KiberniktoChatInfo.from_dict(snapshot['chat_info']) if snapshot.get('chat_info') else None
+    bot = _new_executor(key_id=key_id, chat_info=chat_info)
+    bot.import_state(snapshot)
+    logger.info(f"executor {key_id} woke up with {len(bot.messages)} messages")
     return bot
 
 
@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import threading
+import zlib
+
+logger = logging.getLogger("kibernikto.hibernation")
+
+_FILE_EXTENSION = ".kbnkt"
+
+
+def _json_default(value):
+    if hasattr(value, 'model_dump'):
+        return value.model_dump(mode="json")
+    return str(value)
+
+
+def _file_path(location: str, key: int | str) -> str:
+    return os.path.join(location, f"{key}{_FILE_EXTENSION}")
+
+
+def save(location: str, key: int | str, snapshot: dict):
+    """
+    Saves the executor snapshot as zlib compressed json.
+
+    :param location: hibernation directory
+    :param key: executor key
+    :param snapshot: json serializable executor data
+    """
+    os.makedirs(location, exist_ok=True)
+    data = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':'), default=_json_default)
+    file_path = _file_path(location, key)
+    # written aside and moved in place: a reader never sees a half written file
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(data.encode('utf-8')))
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def exists(location: str, key: int | str) -> bool:
+    return os.path.exists(_file_path(location, key))
+
+
+def load(location: str, key: int | str, remove=True) -> dict | None:
+    """
+    Loads the executor snapshot if any.
+
+    :param location: hibernation directory
+    :param key: executor key
+    :param remove: if to delete the file after loading
+    :return: snapshot dict or None
+    """
+    file_path = _file_path(location, key)
+    try:
+        with open(file_path, 'rb') as f:
+            snapshot = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"failed to load hibernated executor {key}: {e}")
+        snapshot = None
+
+    if remove:
+        remove_snapshot(location, key)
+    return snapshot
+
+
+def remove_snapshot(location: str, key: int | str):
+    try:
+        os.remove(_file_path(location, key))
+    except OSError:
+        pass
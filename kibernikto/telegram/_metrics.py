@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.types import Message
+from pydantic_settings import BaseSettings
+
+from kibernikto.utils.metrics import METRICS, SLOW_BUCKETS, start_metrics_server
+
+
+class MetricsSettings(BaseSettings):
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 0  # 0 to not serve the metrics
+
+
+METRICS_SETTINGS = MetricsSettings()
+
+UPDATE_LAG_SECONDS = METRICS.histogram("kibernikto_update_lag_seconds",
+                                       "Time from the message date to its handling start",
+                                       labels=("chat_type",), buckets=SLOW_BUCKETS)
+PREPROCESS_SECONDS = METRICS.histogram("kibernikto_preprocess_seconds",
+                                       "Message preprocessing time: downloads, transcriptions etc",
+                                       labels=("content_type",), buckets=SLOW_BUCKETS)
+TELEGRAM_REQUEST_SECONDS = METRICS.histogram("kibernikto_telegram_request_seconds",
+                                             "Telegram API call time: sending, editing messages etc",
+                                             labels=("method",), buckets=SLOW_BUCKETS)
+TELEGRAM_ERRORS = METRICS.counter("kibernikto_telegram_errors_total", "Failed Telegram API calls",
+                                  labels=("method",))
+
+__SERVER = None
+
+
+async def record_update_lag(handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]], message: Message,
+                            data: Dict[str, Any]) -> Any:
+    """
+    Outer message middleware: observes how late the messages are handled.
+    """
+    if message.date is not None:
+        UPDATE_LAG_SECONDS.observe(max(0.0, (datetime.now(timezone.utc) - message.date).total_seconds()),
+                                   message.chat.type)
+    return await handler(message, data)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """
+    Bot session middleware observing Telegram API calls time. Long polling is not counted.
+    """
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        method_name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            response = await make_request(bot, method)
+        except Exception:
+            TELEGRAM_ERRORS.inc(method_name)
+            raise
+        TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - start, method_name)
+        return response
+
+
+async def serve_metrics():
+    """
+    Starts the metrics endpoint if METRICS_PORT is set, once.
+    """
+    global __SERVER
+    if METRICS_SETTINGS.METRICS_PORT and __SERVER is None:
+        host, port = METRICS_SETTINGS.METRICS_HOST, METRICS_SETTINGS.METRICS_PORT
+        __SERVER = await start_metrics_server(host, port)
+        print('\t%-15s%-15s' % ("metrics:", f"http://{host}:{port}/metrics"))
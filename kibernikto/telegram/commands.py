@@ -18,9 +18,9 @@ class CommandSettings(BaseSettings):
 PP_SETTINGS = CommandSettings()
 
 if PP_SETTINGS.TG_ADMIN_COMMANDS_ALLOWED:
-    from kibernikto.telegram import dispatcher, get_ai_executor
+    from kibernikto.telegram import dispatcher, get_ai_executor, memory_stats
 
-    print('\t%-20s%-20s' % ("service commands:", '["/system_message"]'))
+    print('\t%-20s%-20s' % ("service commands:", '["/system_message", "/memory"]'))
 
 
     @dispatcher.dp.message(Command(commands=["system_message"]))
@@ -42,5 +42,32 @@ if PP_SETTINGS.TG_ADMIN_COMMANDS_ALLOWED:
                 await message.reply(f"❌Не при всех!")
         else:
             await message.reply(f"❌Вам нельзя!")
+
+
+    def _mb(size: int) -> str:
+        return f"{size / 1024 / 1024:.2f} MB"
+
+
+    @dispatcher.dp.message(Command(commands=["memory"]))
+    async def memory_message(message: types.Message, command: CommandObject):
+        if is_from_admin(message) and PP_SETTINGS.TG_ADMIN_COMMANDS_ALLOWED:
+            if message.chat.type != enums.ChatType.PRIVATE:
+                await message.reply(f"❌Не при всех!")
+                return None
+            top = int(command.args) if command.args and command.args.strip().isdigit() else 10
+            stats = memory_stats(top=top)
+            text = (f"Исполнителей: {stats['executors']} (активных {stats['active']}, простаивают {stats['idle']})\n"
+                    f"Всего: {_mb(stats['total_bytes'])}\n"
+                    f"История: {_mb(stats['history_bytes'])}\n"
+                    f"Конфиги: {_mb(stats['config_bytes'])}\n"
+                    f"Чаты: {_mb(stats['chat_info_bytes'])}\n"
+                    f"Клиенты: {_mb(stats['client_bytes'])}\n")
+            if stats['top']:
+                text += "\nСамые тяжёлые:\n" + "\n".join(
+                    f"```{chat['key']}``` {_mb(chat['total_bytes'])}, {chat['messages']} сообщений"
+                    for chat in stats['top'])
+            await reply(message, text)
+        else:
+            await message.reply(f"❌Вам нельзя!")
 else:
     print('\t%-20s%-20s' % ("service commands:", 'disabled'))
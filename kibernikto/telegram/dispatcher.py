@@ -12,7 +12,10 @@ from pydantic_settings import BaseSettings
 
 from kibernikto.interactors import OpenAiExecutorConfig
 from kibernikto.interactors.tools import Toolbox
+from kibernikto.utils.metrics import METRICS
 from kibernikto.telegram.pre_processors import TelegramMessagePreprocessor
+from ._chat_inbox import ChatInbox
+from ._metrics import record_update_lag, TelegramRequestMetrics, serve_metrics
 from ._executor_corral import init as init_ai_bot_corral, get_ai_executor_full, kill as kill_animals, get_temp_executor, \
     executor_exists
 
@@ -27,6 +30,10 @@ class TelegramSettings(BaseSettings):
     TG_REACTION_CALLS: List[str] = ['honda', 'киберникто']
     TG_SAY_HI: bool = False
     TG_PRIVILEGED_USERS: List[int] = []
+    TG_STREAM_REPLIES: bool = False
+    TG_STREAM_EDIT_INTERVAL: float = 1.2
+    TG_INBOX_DEBOUNCE_SECONDS: float = 0.0
+    TG_INBOX_MAX_WAIT_SECONDS: float = 5.0
     TG_STICKER_LIST: List[str] = ["CAACAgIAAxkBAAELx29l_2OsQzpRWhmXTIMBM4yekypTOwACdgkAAgi3GQI1Wnpqru6xgTQE"]
 
 
@@ -40,6 +47,10 @@ tg_bot: Bot = None
 bot_me: User = None
 dp = Dispatcher()
 preprocessor = TelegramMessagePreprocessor()
+inbox = ChatInbox(debounce_seconds=TELEGRAM_SETTINGS.TG_INBOX_DEBOUNCE_SECONDS,
+                  max_wait_seconds=TELEGRAM_SETTINGS.TG_INBOX_MAX_WAIT_SECONDS)
+dp.message.outer_middleware(record_update_lag)
+METRICS.register_stats("kibernikto_inbox", lambda: {"queue_depth": inbox.queue_depth()})
 
 COMMANDS: List[BotCommand] = []
 
@@ -76,6 +87,7 @@ def start(bot_class, tools=[], msg_preprocessor: TelegramMessagePreprocessor = N
     smart_bot_class = bot_class
     dp.startup.register(on_startup)
     tg_bot = Bot(token=TELEGRAM_SETTINGS.TG_BOT_KEY)
+    tg_bot.session.middleware(TelegramRequestMetrics())
     from . import _default_handlers as dh
     dh.imported_ok()
     dp.run_polling(tg_bot, skip_updates=True)
@@ -105,6 +117,7 @@ async def async_start(bot_class, tools=[], msg_preprocessor=None):
     dp.startup.register(on_startup)
 
     tg_bot = Bot(token=TELEGRAM_SETTINGS.TG_BOT_KEY)
+    tg_bot.session.middleware(TelegramRequestMetrics())
     from . import _default_handlers as dh
     dh.imported_ok()
     await dp.start_polling(tg_bot, skip_updates=True)
@@ -128,6 +141,7 @@ async def on_startup(bot: Bot):
                            master_id=TELEGRAM_SETTINGS.TG_MASTER_ID,
                            username=bot_me.username,
                            config=executor_config)
+        await serve_metrics()
 
         if TELEGRAM_SETTINGS.TG_SAY_HI:
             master_id = TELEGRAM_SETTINGS.TG_MASTER_ID
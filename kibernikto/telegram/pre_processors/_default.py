@@ -8,10 +8,10 @@ import aiofiles
 from aiogram import types, enums, Bot as AIOGramBot
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import FSInputFile
-from openai import AsyncOpenAI
 from openai.resources.audio import AsyncTranscriptions
 from pydantic_settings import BaseSettings
 
+from kibernikto.interactors.clients import get_client
 from kibernikto.utils.image import publish_image_file
 from . import _gladia
 from kibernikto.utils import permissions
@@ -191,8 +191,8 @@ class TelegramMessagePreprocessor():
         :return: Transcription text or the transcription object.
         :rtype: tuple(str or object, None)
         """
-        client = AsyncOpenAI(base_url=SETTINGS.VOICE_OPENAI_API_BASE_URL,
-                             api_key=SETTINGS.VOICE_OPENAI_API_KEY)
+        client = get_client(base_url=SETTINGS.VOICE_OPENAI_API_BASE_URL,
+                            api_key=SETTINGS.VOICE_OPENAI_API_KEY)
         audio_client: AsyncTranscriptions = AsyncTranscriptions(client=client)
 
         # not converted actually :)
@@ -1,4 +1,4 @@
-from aiogram.types import Chat, User
+from aiogram.types import Chat, User, BusinessIntro
 from aiogram.enums import ChatType
 from openai import AsyncOpenAI
 from openai._types import NOT_GIVEN
@@ -22,6 +22,31 @@ class KiberniktoChatInfo:
             self.bio = aiogram_chat.description
         self.aiogram_user = aiogram_user
 
+    def to_dict(self) -> dict:
+        return {
+            "full_name": self.full_name,
+            "bio": self.bio,
+            "description": self.description,
+            "business_intro": self.business_intro.model_dump(mode="json") if self.business_intro else None,
+            "birthday": self.birthday,
+            "is_personal": self.is_personal,
+            "id": self.id,
+            "aiogram_user": self.aiogram_user.model_dump(mode="json") if self.aiogram_user else None
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "KiberniktoChatInfo":
+        """
+        restores the chat info saved with to_dict() without calling Telegram again
+        """
+        chat_info = cls.__new__(cls)
+        chat_info.__dict__.update(data)
+        if data.get("aiogram_user"):
+            chat_info.aiogram_user = User.model_validate(data["aiogram_user"])
+        if data.get("business_intro"):
+            chat_info.business_intro = BusinessIntro.model_validate(data["business_intro"])
+        return chat_info
+
 
 class TelegramBot(OpenAIExecutor):
     def __init__(self, config: OpenAiExecutorConfig, username, key=NOT_GIVEN,
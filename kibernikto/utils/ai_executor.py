@@ -2,7 +2,9 @@ import logging
 
 from aiogram.types import Message, Chat
 
-from kibernikto.telegram import executor_exists, get_ai_executor_full
+from kibernikto.interactors import Priority
+from kibernikto.telegram import executor_exists, get_ai_executor_full, wake_executor
+from kibernikto.utils.permissions import is_from_admin
 
 logger = logging.getLogger("kibernikto")
 
@@ -18,6 +20,7 @@ async def get_ready_executor(message: Message, hide_errors: bool = True):
 
     chat_id = message.chat.id
 
+    await wake_executor(chat_id)
     if not executor_exists(chat_id):
         chat_info: Chat = await message.bot.get_chat(chat_id)
         just_created_executor = True
@@ -32,3 +35,16 @@ async def get_ready_executor(message: Message, hide_errors: bool = True):
         user_ai.full_config.max_messages = user_ai.full_config.max_messages * 2
         user_ai.full_config.max_tokens = user_ai.full_config.max_tokens * 2
     return user_ai
+
+
+def get_priority(message: Message) -> Priority:
+    """
+    :return: LLM calls priority of the turn answering the message
+    """
+    from kibernikto.telegram.dispatcher import TELEGRAM_SETTINGS
+
+    if is_from_admin(message) or message.chat.id in TELEGRAM_SETTINGS.TG_PRIVILEGED_USERS:
+        return Priority.privileged
+    if message.chat.type == 'private':
+        return Priority.private
+    return Priority.group
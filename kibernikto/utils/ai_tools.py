@@ -1,19 +1,27 @@
-import inspect
+import asyncio
 import json
 import logging
-import pprint
-from typing import Callable, List
+import time
+from contextlib import nullcontext
+from typing import Awaitable, Callable, List
 
 # Initialize logger
 logger = logging.getLogger("kibernikto.ai_tools")
 
 from dict2xml import dict2xml
-from openai.types.chat import ChatCompletionMessageToolCall
+from openai.types.chat import ChatCompletionMessageToolCall, ChatCompletionMessage
 from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
 from openai.types.chat.chat_completion_message_tool_call import Function
 
+from ..bots.ai_settings import AI_SETTINGS
+from .cache import TTLCache, SingleFlight, MISSING, make_key
+from .metrics import METRICS, SLOW_BUCKETS
 from .text import parse_json_garbage
-from ..interactors.tools import Toolbox
+from .tokens import estimate_tokens
+from .tool_pools import invoke
+from .tool_results import serialize_result, allocate_budgets, compact_result
+from ..interactors.tools import Toolbox, ToolSpec, ToolArgumentsError, ToolRegistry, get_tool_registry
 
 
 def tool_to_claude_dict(tool: Toolbox):
@@ -40,53 +48,284 @@ def is_function_call(choice: Choice):
     return choice.finish_reason == "tool_calls" or (choice.message.tool_calls and len(choice.message.tool_calls) > 0)
 
 
-async def run_tool_calls(choice: Choice, available_tools: list[Toolbox], unique_id: str, call_session_id: str = None):
+def merge_tool_call_deltas(tool_calls: dict[int, dict], deltas: List[ChoiceDeltaToolCall]):
+    """
+    Streaming responses deliver tool calls in pieces: accumulating them by index.
+    """
+    for delta in deltas:
+        tool_call = tool_calls.setdefault(delta.index, {"id": None, "name": "", "arguments": ""})
+        if delta.id:
+            tool_call["id"] = delta.id
+        if delta.function:
+            if delta.function.name:
+                tool_call["name"] += delta.function.name
+            if delta.function.arguments:
+                tool_call["arguments"] += delta.function.arguments
+
+
+def assemble_streamed_choice(content: str, tool_calls: dict[int, dict], finish_reason: str = None) -> Choice:
+    """
+    Builds a usual Choice from the streamed pieces so the rest of the code does not care about streaming.
+    """
+    message_tool_calls = [
+        ChatCompletionMessageToolCall(id=tool_call["id"], type="function",
+                                      function=Function(name=tool_call["name"], arguments=tool_call["arguments"]))
+        for _, tool_call in sorted(tool_calls.items())
+    ]
+    message = ChatCompletionMessage(role="assistant", content=content or None, tool_calls=message_tool_calls or None)
+    if not finish_reason:
+        finish_reason = "tool_calls" if message_tool_calls else "stop"
+    return Choice(index=0, finish_reason=finish_reason, message=message)
+
+
+async def run_tool_calls(choice: Choice, available_tools: list[Toolbox], unique_id: str, call_session_id: str = None,
+                         timings: list = None, full_results: dict = None,
+                         summarizer: Callable[[str, str, int], Awaitable[str]] = None,
+                         registry: ToolRegistry = None):
+    """
+    Runs all the tool calls of the given choice concurrently.
+    Results bigger than the tool or the turn budget are compacted before going to the history.
+
+    :param choice: model choice with tool calls
+    :param available_tools: tools to look implementations in
+    :param unique_id: executor unique id, is given to tools as 'key' param
+    :param call_session_id: current user call session id
+    :param timings: if given, (tool name, seconds) pairs are appended here
+    :param full_results: if given, the uncut results are put here by tool call id
+    :param summarizer: (tool name, result text, max tokens) -> shorter text, is used before the cutting
+    :param registry: prepared registry of the available tools, looked up if not given
+    :return: assistant/tool message pairs in the original tool calls order
+    """
     if not choice.message.tool_calls:
         raise ValueError("No tools provided!")
 
-    # if is None it's a recursive tool call
-    tool_call_messages = []
+    additional_params = dict(key=unique_id, call_session_id=call_session_id)
+    registry = registry or get_tool_registry(available_tools)
+    # identical calls of this answer
+    turn_calls: dict[tuple, asyncio.Future] = {}
 
-    for tool_call in choice.message.tool_calls:
+    async def run_one(tool_call: ChatCompletionMessageToolCall):
         fn_name = tool_call.function.name
-        function_impl = get_tool_impl(available_tools=available_tools, fn_name=fn_name)
-        if not function_impl:
+        spec = registry.get(fn_name)
+        start = time.perf_counter()
+        if not spec:
             logger.error(f"no impl for {fn_name}")
-            pprint.pprint(tool_call)
-        additional_params = dict(key=unique_id, call_session_id=call_session_id)
-        tool_call_result = await execute_tool_call_function(tool_call, function_impl=function_impl,
-                                                            additional_params=additional_params)
-        tool_call_messages += get_tool_call_serving_messages(tool_call, tool_call_result, choice=choice)
+            tool_call_result = {"error": "UNKNOWN_TOOL", "tool": fn_name, "available_tools": registry.names}
+        elif spec.toolbox.deduplicated:
+            turn_key = (fn_name, tool_call.function.arguments)
+            call = turn_calls.get(turn_key)
+            if call is None:
+                call = asyncio.ensure_future(_call_tool(spec, tool_call, additional_params))
+                turn_calls[turn_key] = call
+            else:
+                _DEDUPLICATED[spec.name] = _DEDUPLICATED.get(spec.name, 0) + 1
+            tool_call_result = await call
+        else:
+            tool_call_result = await _call_tool(spec, tool_call, additional_params)
+        elapsed = time.perf_counter() - start
+        logger.info(f"⏱ '{fn_name}' took {elapsed:.3f} seconds")
+        if timings is not None:
+            timings.append((fn_name, elapsed))
+        return tool_call_result
+
+    tool_calls = choice.message.tool_calls
+    results = await asyncio.gather(*[run_one(tool_call) for tool_call in tool_calls])
+    if full_results is not None:
+        for tool_call, tool_call_result in zip(tool_calls, results):
+            full_results[tool_call.id] = tool_call_result
+    results = await _fit_results(tool_calls, results, registry, summarizer)
 
+    tool_call_messages = []
+    for tool_call, tool_call_result in zip(tool_calls, results):
+        tool_call_messages += get_tool_call_serving_messages(tool_call, tool_call_result, choice=choice)
     return tool_call_messages
 
 
+async def _fit_results(tool_calls: list[ChatCompletionMessageToolCall], results: list, registry: ToolRegistry,
+                       summarizer: Callable[[str, str, int], Awaitable[str]] = None) -> list:
+    """
+    Fits the results into the tool and the turn budgets.
+    """
+    texts = [serialize_result(tool_call_result) for tool_call_result in results]
+    caps = []
+    for tool_call in tool_calls:
+        spec = registry.get(tool_call.function.name)
+        cap = spec.toolbox.max_result_tokens if spec and spec.toolbox.max_result_tokens is not None else None
+        caps.append(cap if cap is not None else AI_SETTINGS.OPENAI_TOOLS_MAX_RESULT_TOKENS)
+    budgets = allocate_budgets([estimate_tokens(text) for text in texts], caps,
+                               AI_SETTINGS.OPENAI_TOOLS_TURN_RESULT_TOKENS)
+
+    async def fit(tool_call: ChatCompletionMessageToolCall, tool_call_result, text: str, budget: int):
+        if not budget or estimate_tokens(text) <= budget:
+            return text
+        if summarizer:
+            try:
+                summary = await summarizer(tool_call.function.name, text, budget)
+                if summary and estimate_tokens(summary) <= budget:
+                    return f"{summary}\n[RESULT SUMMARIZED]"
+            except Exception as e:
+                logger.warning(f"failed to summarize '{tool_call.function.name}' result: {e}")
+        return compact_result(tool_call_result, budget)
+
+    return await asyncio.gather(*[fit(tool_call, tool_call_result, text, budget) for
+                                  tool_call, tool_call_result, text, budget in
+                                  zip(tool_calls, results, texts, budgets)])
+
+
+async def _call_tool(spec: ToolSpec, tool_call: ChatCompletionMessageToolCall, additional_params: dict):
+    """
+    Runs the tool or takes its result from the cache if the tool has a cache policy.
+    """
+    async def execute():
+        timeout = spec.toolbox.timeout if spec.toolbox.timeout is not None else AI_SETTINGS.OPENAI_TOOLS_TIMEOUT
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(timeout or None):
+                async with _get_tool_semaphore(spec.toolbox):
+                    result = await execute_tool_call_function(tool_call, spec=spec,
+                                                              additional_params=additional_params)
+        except TimeoutError:
+            logger.warning(f"'{spec.name}' did not finish in {timeout} seconds")
+            _TIMEOUTS[spec.name] = _TIMEOUTS.get(spec.name, 0) + 1
+            result = {"error": "[TOOL TIMED OUT]", "tool": spec.name, "timeout_seconds": timeout,
+                      "hint": "the tool did not answer in time, reply with what you already have"}
+        TOOL_SECONDS.observe(time.perf_counter() - start, spec.name,
+                             'error' if _is_failed_result(result) else 'ok')
+        return result
+
+    policy = spec.toolbox.cache
+    cache_key = _tool_cache_key(spec, tool_call.function.arguments, additional_params.get('key')) if policy else None
+    if cache_key is None:
+        return await execute()
+
+    cache = _get_tool_cache(spec.toolbox)
+    cached = cache.get(cache_key)
+    if cached is not MISSING:
+        return cached
+
+    async def execute_and_cache():
+        result = await execute()
+        if not _is_failed_result(result):
+            cache.set(cache_key, result, ttl=policy.ttl)
+        return result
+
+    # the same lookup from several chats at once is run once
+    return await _TOOL_FLIGHTS.do(cache_key, execute_and_cache)
+
+
+def _tool_cache_key(spec: ToolSpec, arguments: str | None, unique_id) -> str | None:
+    try:
+        dict_args = json.loads(arguments) if arguments else {}
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(dict_args, dict):
+        return None
+    policy = spec.toolbox.cache
+    if policy.key_fields is not None:
+        dict_args = {field: dict_args.get(field) for field in policy.key_fields}
+    scope = f"{unique_id}" if policy.scope == 'chat' else None
+    return make_key(spec.name, scope, dict_args)
+
+
+def _is_failed_result(result) -> bool:
+    if isinstance(result, dict):
+        return 'error' in result
+    return isinstance(result, str) and '[TOOL CALL FAILED]' in result
+
+
+# (function name, max concurrency) -> semaphore: toolboxes with other limits do not share it
+_TOOL_SEMAPHORES: dict[tuple[str, int], asyncio.Semaphore] = {}
+_TOOL_CACHES: dict[str, TTLCache] = {}
+_TOOL_FLIGHTS = SingleFlight()
+# identical calls in one answer run once
+_DEDUPLICATED: dict[str, int] = {}
+_TIMEOUTS: dict[str, int] = {}
+
+TOOL_SECONDS = METRICS.histogram("kibernikto_tool_seconds", "Tool call time, waiting for the tool slot included",
+                                 labels=("tool", "outcome"), buckets=SLOW_BUCKETS)
+
+
+def _get_tool_cache(toolbox: Toolbox) -> TTLCache:
+    cache = _TOOL_CACHES.get(toolbox.function_name)
+    if cache is None:
+        cache = TTLCache(max_entries=toolbox.cache.max_entries, ttl=toolbox.cache.ttl)
+        _TOOL_CACHES[toolbox.function_name] = cache
+    return cache
+
+
+def tool_cache_stats() -> dict:
+    """
+    :return: cache entries, hits and misses per cached tool, deduplicated calls per tool
+    """
+    stats = {name: {**cache.stats(), "deduplicated": 0} for name, cache in _TOOL_CACHES.items()}
+    for name, deduplicated in _DEDUPLICATED.items():
+        stats.setdefault(name, {"deduplicated": 0})["deduplicated"] = deduplicated
+    return {"tools": stats, "coalesced": _TOOL_FLIGHTS.coalesced}
+
+
+def tool_timeout_stats() -> dict:
+    """
+    :return: timed out calls per tool
+    """
+    return dict(_TIMEOUTS)
+
+
+METRICS.register_stats("kibernikto_tool_cache", lambda: tool_cache_stats()["tools"], label="tool")
+METRICS.register_stats("kibernikto_tool_flights", lambda: {"coalesced": _TOOL_FLIGHTS.coalesced})
+METRICS.register_stats("kibernikto_tool", lambda: {name: {"timeouts": timeouts}
+                                                   for name, timeouts in tool_timeout_stats().items()}, label="tool")
+
+
+def _get_tool_semaphore(toolbox: Toolbox | None):
+    if toolbox is None or not toolbox.max_concurrency:
+        return nullcontext()
+    semaphore_key = (toolbox.function_name, toolbox.max_concurrency)
+    semaphore = _TOOL_SEMAPHORES.get(semaphore_key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(toolbox.max_concurrency)
+        _TOOL_SEMAPHORES[semaphore_key] = semaphore
+    return semaphore
+
+
+def get_toolbox(available_tools: list[Toolbox], fn_name: str) -> Toolbox | None:
+    spec = get_tool_registry(available_tools).get(fn_name)
+    return spec.toolbox if spec else None
+
+
 def get_tool_impl(available_tools: list[Toolbox], fn_name: str) -> Callable:
-    for x in available_tools:
-        if x.function_name == fn_name:
-            return x.implementation
-    return None
+    spec = get_tool_registry(available_tools).get(fn_name)
+    return spec.implementation if spec else None
 
 
 async def execute_tool_call_function(tool_call: ChatCompletionMessageToolCall,
-                                     function_impl: Callable, additional_params: dict = {}):
+                                     function_impl: Callable = None, additional_params: dict = {},
+                                     spec: ToolSpec = None):
+    """
+    Runs the tool implementation with the model arguments.
+
+    :param tool_call: model tool call
+    :param function_impl: tool implementation, only if there is no spec
+    :param additional_params: executor params for the tools declaring them
+    :param spec: prepared tool spec from the ToolRegistry
+    :return: tool result or error description for the model
+    """
     tool_call_function: Function = tool_call.function
     fn_name = tool_call_function.name
-    arguments: str = tool_call_function.arguments
+    if spec is None:
+        spec = ToolSpec(fn_name, function_impl)
 
-    if arguments is None:
-        dict_args = {}
-    else:
-        dict_args = json.loads(arguments)
-
-    impl_params = inspect.getfullargspec(function_impl)[0]
+    try:
+        dict_args = spec.parse_arguments(tool_call_function.arguments)
+    except ToolArgumentsError as e:
+        logger.warning(f"{e}")
+        return e.to_result()
 
-    for key in additional_params:
-        if key in impl_params:
+    for key in spec.injectable:
+        if key in additional_params:
             dict_args[key] = additional_params[key]
     logger.info(f"👷‍♀️ running '{fn_name}' with params {dict_args}")
     try:
-        result = await function_impl(**dict_args)
+        result = await invoke(spec.implementation, dict_args, spec.execution)
     except Exception as e:
         logger.error(f"{e}", exc_info=True)
         try:
@@ -121,10 +360,7 @@ def get_tool_call_serving_messages(tool_call: ChatCompletionMessageToolCall, too
         if hasattr(choice.message, 'reasoning_details'):
             call_message['reasoning_details'] = choice.message.reasoning_details
 
-    if isinstance(tool_call_result, (dict, list)):
-        result_content = json.dumps(tool_call_result, ensure_ascii=False, default=str)
-    else:
-        result_content = str(tool_call_result)
+    result_content = serialize_result(tool_call_result)
 
     result_message = {
         # "role": "function",
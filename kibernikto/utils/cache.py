@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Callable, Awaitable
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded in-memory cache with per-entry time to live and LRU eviction.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600):
+        """
+        :param max_entries: max number of entries, least recently used are evicted first
+        :param ttl: seconds an entry lives
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default=MISSING):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value, ttl: float = None):
+        self._entries[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0
+        }
+
+
+def make_key(*parts) -> str:
+    """
+    Stable hash of any json serializable parts.
+    """
+    data = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller runs the call, the others await the same result.
+    Nothing is cached: failures reach all the waiters, the next call after completion runs again.
+    The call is cancelled when all its waiters are gone.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[Hashable, int] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable]):
+        """
+        :param key: identical calls key
+        :param call: coroutine function to run if there is no such call in flight
+        :return: the call result
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done_task: self._forget(key, done_task))
+        else:
+            self.coalesced += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # one waiter giving up must not cancel the call for the others
+            return await asyncio.shield(task)
+        finally:
+            waiters = self._waiters.get(key, 1) - 1
+            if waiters > 0:
+                self._waiters[key] = waiters
+            else:
+                self._waiters.pop(key, None)
+                if not task.done():
+                    task.cancel()
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # marking the exception as retrieved in case all the waiters are gone
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
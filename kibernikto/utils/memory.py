@@ -0,0 +1,42 @@
+import sys
+import types
+from typing import Any
+
+# not owned by the measured object
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+               types.CodeType, types.FrameType)
+
+
+def deep_size(obj: Any, max_objects: int = 10000) -> int:
+    """
+    Approximate bytes taken by the object and everything it refers to.
+    Classes, modules and functions are not counted, shared objects are counted once.
+
+    :param obj: object to measure
+    :param max_objects: stop after visiting that many objects: the size is a lower bound then
+    :return: bytes
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack and len(seen) < max_objects:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, _SKIP_TYPES):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, (str, bytes, bytearray, int, float, bool)) or current is None:
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        if hasattr(current, '__dict__'):
+            stack.append(vars(current))
+        for cls in type(current).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            for slot in (slots,) if isinstance(slots, str) else slots:
+                if slot not in ('__dict__', '__weakref__') and hasattr(current, slot):
+                    stack.append(getattr(current, slot))
+    return size
@@ -2,37 +2,56 @@ import logging
 import random
 import time
 from contextlib import contextmanager
-from typing import Optional
+from typing import Optional, AsyncIterator, Iterator
 
 from aiogram.enums import ParseMode
 from aiogram.types import Message, FSInputFile
 
+from .metrics import Histogram
 from .text import clear_text_format, split_text_by_sentences, prepare_for_MARKDOWN
 
 # Extracted constants
 STICKER_PROBABILITY = 0.13
 MAX_CAPTION_LENGTH = 1023
 DEFAULT_MAX_MESSAGE_LENGTH = 4096
+DEFAULT_STREAM_EDIT_INTERVAL = 1.2
 
 logger = logging.getLogger(__name__)
 
 
+class Timing:
+    """
+    Result of the timer, elapsed is set when the block is over.
+    """
+    __slots__ = ('elapsed',)
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+
 @contextmanager
-def timer(description: str = "Execution time") -> float:
+def timer(description: str = "Execution time", histogram: Optional[Histogram] = None,
+          labels: tuple = ()) -> Iterator[Timing]:
     """
     Context manager to measure execution time of code blocks.
 
     Args:
         description: Description for the timer output
+        histogram: Optional histogram to observe the elapsed time in
+        labels: Label values for the histogram
 
     Returns:
-        float: The elapsed time in seconds
+        Timing: its elapsed attribute is the elapsed time in seconds after the block
     """
+    timing = Timing()
     start = time.perf_counter()
-    yield
-    elapsed_time = time.perf_counter() - start
-    logger.info(f"{description}: {elapsed_time:.3f} seconds")
-    return elapsed_time
+    try:
+        yield timing
+    finally:
+        timing.elapsed = time.perf_counter() - start
+        if histogram is not None:
+            histogram.observe(timing.elapsed, *labels)
+        logger.info(f"{description}: {timing.elapsed:.3f} seconds")
 
 
 async def reply(
@@ -96,6 +115,106 @@ async def _text_reply(message: Message, reply_text: str) -> None:
         await _send_random_sticker(message)
 
 
+async def stream_reply(
+        message: Message,
+        deltas: AsyncIterator[str],
+        edit_interval: float = DEFAULT_STREAM_EDIT_INTERVAL,
+        max_length: int = DEFAULT_MAX_MESSAGE_LENGTH
+) -> str:
+    """
+    Reply to a Telegram message with a text that is still being generated.
+    The first piece is sent as soon as it arrives, then the message is edited not more often than edit_interval.
+    When the text does not fit into one message, the current one is finished and the next one is started.
+
+    Args:
+        message: The message to reply to
+        deltas: Async iterator of the reply text pieces
+        edit_interval: Minimal time in seconds between the edits of the same message
+        max_length: Telegram message length limit
+
+    Returns:
+        str: The full sent text
+    """
+    full_text = ""
+    current_text = ""
+    current_message: Optional[Message] = None
+    shown_text = ""
+    last_edit = 0.0
+
+    async for delta in deltas:
+        if not delta:
+            continue
+        full_text += delta
+        current_text += delta
+
+        while len(current_text) > max_length:
+            cut = _find_stream_cut(current_text, max_length)
+            await _draft_message(message, current_message, current_text[:cut].rstrip(), shown_text, final=True)
+            current_text = current_text[cut:].lstrip()
+            current_message, shown_text, last_edit = None, "", 0.0
+
+        if not current_text.strip():
+            continue
+
+        now = time.monotonic()
+        if current_message is None or now - last_edit >= edit_interval:
+            current_message = await _draft_message(message, current_message, current_text, shown_text)
+            shown_text, last_edit = current_text, now
+
+    if current_text.strip():
+        await _draft_message(message, current_message, current_text, shown_text, final=True)
+    elif not full_text.strip():
+        full_text = "My iron brain did not generate anything!"
+        await message.reply(text=full_text)
+
+    if random.random() < STICKER_PROBABILITY:
+        await _send_random_sticker(message)
+    return full_text
+
+
+def _find_stream_cut(text: str, max_length: int) -> int:
+    """
+    Finds the best place to split the streamed text not longer than max_length: paragraph, sentence, word.
+    """
+    for separator in ("\n\n", ". ", "\n", " "):
+        position = text.rfind(separator, 0, max_length)
+        if position > max_length // 2:
+            return position + len(separator)
+    return max_length
+
+
+async def _draft_message(message: Message, draft: Optional[Message], text: str, shown_text: str,
+                         final: bool = False) -> Message:
+    """
+    Sends or edits the draft message. Formatting is applied only to the final version,
+    as unfinished markdown can not be parsed by Telegram.
+    """
+    if not final:
+        if draft is None:
+            return await message.reply(text=clear_text_format(text))
+        if text != shown_text:
+            try:
+                await draft.edit_text(text=clear_text_format(text))
+            except Exception as e:
+                logger.debug(f"Error editing streamed message: {e}")
+        return draft
+
+    send = draft.edit_text if draft is not None else message.reply
+    try:
+        result = await send(text=prepare_for_MARKDOWN(text), parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        logger.error(f"Error sending formatted message: {e}")
+        logger.debug(f"Problematic chunk: {text}")
+        try:
+            result = await send(text=clear_text_format(text))
+        except Exception as e:
+            # most probably the text is not modified
+            logger.debug(f"Error sending streamed message: {e}")
+            result = draft
+    # editing can return just True instead of the message
+    return draft if result is None or isinstance(result, bool) else result
+
+
 async def _send_random_sticker(message: Message) -> None:
     """
     Send a random sticker from the configured sticker set.
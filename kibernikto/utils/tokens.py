@@ -0,0 +1,57 @@
+"""
+Offline token count estimations. No tokenizer downloads, good enough for history budgeting.
+"""
+
+# average characters per token for modern BPE tokenizers
+_LATIN_CHARS_PER_TOKEN = 4.0
+# cyrillic and other 2-byte utf-8 scripts are split into much smaller pieces
+_WIDE_CHARS_PER_TOKEN = 2.7
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 765
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the tokens count of the text.
+    Uses utf-8 length to count non-latin characters, so the whole thing is done in C.
+
+    :param text: any text
+    :return: approximate tokens count
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    wide_chars = min(len(text.encode('utf-8')) - chars, chars)
+    return int((chars - wide_chars) / _LATIN_CHARS_PER_TOKEN + wide_chars / _WIDE_CHARS_PER_TOKEN) + 1
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """
+    Estimates the tokens count of the OpenAI message dict including tool calls and images.
+
+    :param message: OpenAI format message
+    :return: approximate tokens count
+    """
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    for tool_call in message.get("tool_calls") or ():
+        function = tool_call.get("function", {}) if isinstance(tool_call, dict) else {}
+        tokens += estimate_tokens(function.get("name", "")) + estimate_tokens(function.get("arguments") or "")
+    return tokens
+
+
+def count_words(message: dict) -> int:
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return len(content.split())
+    return 0
@@ -0,0 +1,77 @@
+import asyncio
+import functools
+import inspect
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Literal
+
+from ..bots.ai_settings import AI_SETTINGS
+
+logger = logging.getLogger("kibernikto.tool_pools")
+
+ExecutionMode = Literal['async', 'thread', 'process']
+
+__THREAD_POOL: ThreadPoolExecutor | None = None
+__PROCESS_POOL: ProcessPoolExecutor | None = None
+
+
+def resolve_execution_mode(implementation: Callable, execution: ExecutionMode | None) -> ExecutionMode:
+    """
+    :param implementation: tool implementation
+    :param execution: declared mode, None to choose by the implementation: sync functions go to threads
+    """
+    if execution:
+        return execution
+    return 'async' if _is_async(implementation) else 'thread'
+
+
+def _is_async(implementation: Callable) -> bool:
+    # callable objects with async __call__ too
+    return (inspect.iscoroutinefunction(implementation) or
+            inspect.iscoroutinefunction(getattr(implementation, '__call__', None)))
+
+
+def _get_pool(execution: ExecutionMode) -> Executor:
+    global __THREAD_POOL, __PROCESS_POOL
+    if execution == 'thread':
+        if __THREAD_POOL is None:
+            __THREAD_POOL = ThreadPoolExecutor(max_workers=AI_SETTINGS.OPENAI_TOOLS_THREADS,
+                                               thread_name_prefix="kibernikto-tool")
+        return __THREAD_POOL
+    if __PROCESS_POOL is None:
+        __PROCESS_POOL = ProcessPoolExecutor(max_workers=AI_SETTINGS.OPENAI_TOOLS_PROCESSES or None)
+    return __PROCESS_POOL
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+def _run_sync(implementation: Callable, kwargs: dict):
+    # coroutines, also the ones returned by plain functions, get their own loop in the pool worker
+    result = implementation(**kwargs)
+    if inspect.isawaitable(result):
+        return asyncio.run(result if inspect.iscoroutine(result) else _await(result))
+    return result
+
+
+async def invoke(implementation: Callable, kwargs: dict, execution: ExecutionMode):
+    """
+    Calls the tool implementation in the given mode.
+    Thread and process pools are shared by all the tools and bounded by
+    OPENAI_TOOLS_THREADS and OPENAI_TOOLS_PROCESSES.
+    Process mode needs a picklable (module level) implementation and arguments.
+    A cancelled or timed out pool call is not interrupted, its result is just dropped.
+    """
+    if execution == 'async':
+        return await implementation(**kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(execution), functools.partial(_run_sync, implementation, kwargs))
+
+
+def shutdown_tool_pools():
+    global __THREAD_POOL, __PROCESS_POOL
+    for pool in (__THREAD_POOL, __PROCESS_POOL):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    __THREAD_POOL, __PROCESS_POOL = None, None
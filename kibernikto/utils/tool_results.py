@@ -0,0 +1,95 @@
+import json
+from typing import Any
+
+from .tokens import estimate_tokens
+
+# never squeeze a result below that
+MIN_RESULT_TOKENS = 200
+
+_MAX_ITEMS = 32
+_MAX_STRING = 2000
+_MAX_DEPTH = 8
+
+
+def serialize_result(result) -> str:
+    """
+    Tool result as the model sees it.
+    """
+    if isinstance(result, (dict, list)):
+        return json.dumps(result, ensure_ascii=False, default=str)
+    return str(result)
+
+
+def allocate_budgets(sizes: list[int], caps: list[int], turn_budget: int) -> list[int]:
+    """
+    Splits the turn budget between the tool results in proportion to their sizes.
+
+    :param sizes: results sizes in tokens
+    :param caps: per tool limits, 0 for no limit
+    :param turn_budget: limit for all the results of the turn, 0 for no limit
+    :return: budget for each result, 0 for no limit
+    """
+    budgets = [min(size, cap) if cap else size for size, cap in zip(sizes, caps)]
+    total = sum(budgets)
+    if not turn_budget or total <= turn_budget:
+        return [cap if cap and size > cap else 0 for size, cap in zip(sizes, caps)]
+    return [max(MIN_RESULT_TOKENS, turn_budget * budget // total) for budget in budgets]
+
+
+def compact_result(result, max_tokens: int) -> str:
+    """
+    Serializes the result fitting it into the budget.
+    Json is cut structurally: all the keys stay, arrays are trimmed and long strings are ellipsized
+    step by step until it fits. Other text is just cut.
+
+    :param result: tool result
+    :param max_tokens: budget, 0 for no limit
+    :return: the result text, with a note if it was cut
+    """
+    text = serialize_result(result)
+    if not max_tokens:
+        return text
+    full_tokens = estimate_tokens(text)
+    if full_tokens <= max_tokens:
+        return text
+
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except ValueError:
+            pass
+
+    compacted = None
+    if isinstance(result, (dict, list)):
+        max_items, max_string, max_depth = _MAX_ITEMS, _MAX_STRING, _MAX_DEPTH
+        while True:
+            compacted = json.dumps(_shrink(result, max_items, max_string, max_depth), ensure_ascii=False,
+                                   default=str)
+            if estimate_tokens(compacted) <= max_tokens:
+                break
+            if max_items == 1 and max_string == 16 and max_depth == 1:
+                compacted = None
+                break
+            max_items, max_string = max(1, max_items // 2), max(16, max_string // 2)
+            max_depth = max(1, max_depth - 1)
+    if compacted is None:
+        chars = max(1, len(text) * max_tokens // full_tokens)
+        compacted = f"{text[:chars]}… [{len(text) - chars} more chars]"
+    return f"{compacted}\n[RESULT TRUNCATED: {full_tokens} tokens in full]"
+
+
+def _shrink(value: Any, max_items: int, max_string: int, depth: int) -> Any:
+    if isinstance(value, dict):
+        if depth <= 0:
+            return f"{{…{len(value)} keys}}"
+        return {key: _shrink(item, max_items, max_string, depth - 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if depth <= 0:
+            return f"[…{len(value)} items]"
+        items = [_shrink(item, max_items, max_string, depth - 1) for item in value[:max_items]]
+        if len(value) > max_items:
+            items.append(f"…{len(value) - max_items} more items")
+        return items
+    if isinstance(value, str) and len(value) > max_string:
+        return f"{value[:max_string]}…[{len(value) - max_string} more chars]"
+    return value
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import random
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+from kibernikto.interactors.batch import BatchError, BatchSubmitter
+
+
+class StandInServer:
+    """
+    Local OpenAI compatible Batch API: files, batches and their results.
+    Batches complete after a number of status checks, the model "bad" gets an error file line.
+    """
+
+    def __init__(self, checks_to_complete: int = 1):
+        self.checks_to_complete = checks_to_complete
+        self.files = {}
+        self.batches = {}
+        self.batch_sizes = []
+        self.cancelled = []
+
+    def client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(api_key="test", base_url="http://stand-in/v1", max_retries=0,
+                           http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle)))
+
+    def _batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        return dict(id=batch_id, object="batch", endpoint="/v1/chat/completions", completion_window="24h",
+                    created_at=1, input_file_id=batch['input_file_id'], status=batch['status'],
+                    output_file_id=batch.get('output_file_id'), error_file_id=batch.get('error_file_id'))
+
+    def _complete(self, batch_id: str):
+        batch = self.batches[batch_id]
+        requests = [json.loads(line) for line in self.files[batch['input_file_id']].splitlines()]
+        # the results come in any order
+        random.shuffle(requests)
+        output, errors = [], []
+        for request in requests:
+            body = request['body']
+            if body['model'] == 'bad':
+                errors.append(dict(custom_id=request['custom_id'],
+                                   response=dict(status_code=400, body=dict(error=dict(message="bad model")))))
+                continue
+            completion = dict(id=f"c-{request['custom_id']}", object="chat.completion", created=1, model=body['model'],
+                              choices=[dict(index=0, finish_reason="stop",
+                                            message=dict(role="assistant", content=body['messages'][-1]['content']))])
+            output.append(dict(custom_id=request['custom_id'], response=dict(status_code=200, body=completion)))
+        for name, lines in (('output_file_id', output), ('error_file_id', errors)):
+            if lines:
+                file_id = f"file-{len(self.files)}"
+                self.files[file_id] = "\n".join(json.dumps(line) for line in lines)
+                batch[name] = file_id
+        batch['status'] = 'completed'
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1")
+        if request.method == "POST" and path == "/files":
+            content = request.read().decode()
+            lines = [line for line in content.splitlines() if line.startswith('{"custom_id"')]
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = "\n".join(lines)
+            return httpx.Response(200, json=dict(id=file_id, object="file", bytes=len(content), created_at=1,
+                                                 filename="kibernikto_batch.jsonl", purpose="batch",
+                                                 status="processed"))
+        if request.method == "POST" and path == "/batches":
+            input_file_id = json.loads(request.read())['input_file_id']
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = dict(input_file_id=input_file_id, status="in_progress", checks=0)
+            self.batch_sizes.append(len(self.files[input_file_id].splitlines()))
+            return httpx.Response(200, json=self._batch(batch_id))
+        if request.method == "POST" and path.endswith("/cancel"):
+            batch_id = path.split("/")[2]
+            self.batches[batch_id]['status'] = 'cancelled'
+            self.cancelled.append(batch_id)
+            return httpx.Response(200, json=self._batch(batch_id))
+        if request.method == "GET" and path.startswith("/batches/"):
+            batch_id = path.split("/")[2]
+            batch = self.batches[batch_id]
+            batch['checks'] += 1
+            if batch['status'] == 'in_progress' and batch['checks'] >= self.checks_to_complete:
+                self._complete(batch_id)
+            return httpx.Response(200, json=self._batch(batch_id))
+        if request.method == "GET" and path.startswith("/files/") and path.endswith("/content"):
+            return httpx.Response(200, text=self.files[path.split("/")[2]])
+        return httpx.Response(404, json=dict(error=dict(message=f"no {request.method} {path}")))
+
+
+def _request(text: str, model: str = "gpt-test") -> dict:
+    return dict(model=model, messages=[dict(role="user", content=text)])
+
+
+def _submitter(server: StandInServer, **kwargs) -> BatchSubmitter:
+    params = dict(window=0.01, max_size=100, poll_interval=0.01, max_poll_interval=0.01)
+    params.update(kwargs)
+    return BatchSubmitter(server.client(), **params)
+
+
+def test_results_go_to_their_callers():
+    async def scenario():
+        submitter = _submitter(server)
+        completions = await asyncio.gather(*(submitter.submit(_request(f"message {i}")) for i in range(5)))
+        return [completion.choices[0].message.content for completion in completions]
+
+    server = StandInServer()
+    assert asyncio.run(scenario()) == [f"message {i}" for i in range(5)]
+    assert server.batch_sizes == [5]
+
+
+def test_error_file_lines_fail_their_requests_only():
+    async def scenario():
+        submitter = _submitter(server)
+        return await asyncio.gather(submitter.submit(_request("fine")), submitter.submit(_request("no", "bad")),
+                                    return_exceptions=True)
+
+    server = StandInServer()
+    good, bad = asyncio.run(scenario())
+    assert good.choices[0].message.content == "fine"
+    assert isinstance(bad, BatchError)
+    assert "bad model" in str(bad)
+
+
+def test_requests_within_the_window_make_one_batch():
+    async def scenario():
+        submitter = _submitter(server, window=0.05)
+        first = asyncio.create_task(submitter.submit(_request("first")))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(submitter.submit(_request("second")))
+        await asyncio.gather(first, second)
+        # the next window is the next batch
+        await submitter.submit(_request("third"))
+
+    server = StandInServer()
+    asyncio.run(scenario())
+    assert server.batch_sizes == [2, 1]
+
+
+def test_full_batch_is_sent_without_waiting_for_the_window():
+    async def scenario():
+        submitter = _submitter(server, window=60, max_size=2)
+        await asyncio.wait_for(asyncio.gather(*(submitter.submit(_request(f"m{i}")) for i in range(2))), 5)
+        submitter.flush()
+
+    server = StandInServer()
+    asyncio.run(scenario())
+    assert server.batch_sizes == [2]
+
+
+def test_abandoned_batch_is_cancelled():
+    async def scenario():
+        submitter = _submitter(server)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(submitter.submit(_request("nobody waits")), 0.05)
+        await asyncio.wait_for(asyncio.gather(*submitter._jobs), 5)
+
+    server = StandInServer(checks_to_complete=1000)
+    asyncio.run(scenario())
+    assert server.cancelled == ["batch-0"]
@@ -0,0 +1,54 @@
+import asyncio
+
+from kibernikto.telegram._chat_inbox import ChatInbox
+
+
+def test_group_turns_do_not_overlap():
+    async def scenario():
+        inbox = ChatInbox()
+        running = 0
+        peak = 0
+
+        async def answer():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        async def first_member():
+            async with inbox.turn(1, "first", merge=False):
+                await answer()
+            # comes right after the release, before the waiting turn takes the lock
+            async with inbox.turn(1, "third", merge=False):
+                await answer()
+
+        async def second_member():
+            await asyncio.sleep(0.001)
+            async with inbox.turn(1, "second", merge=False):
+                await answer()
+
+        await asyncio.gather(first_member(), second_member())
+        return peak, len(inbox._chats)
+
+    peak, chats = asyncio.run(scenario())
+    assert peak == 1
+    assert chats == 0
+
+
+def test_burst_is_merged_into_one_turn():
+    async def scenario():
+        inbox = ChatInbox(debounce_seconds=0.01)
+        turns = []
+
+        async def send(text):
+            async with inbox.turn(1, text) as turn_text:
+                if turn_text is not None:
+                    turns.append(turn_text)
+
+        await asyncio.gather(send("a"), send("b"))
+        return turns, len(inbox._chats)
+
+    turns, chats = asyncio.run(scenario())
+    assert turns == ["a\n\nb"]
+    assert chats == 0